@@ -0,0 +1,912 @@
+"""Offline benchmarks for the bot. Telegram'ga ulanmaydi, vaqtinchalik bazada ishlaydi.
+
+    python bench.py indexes --orders 1000000
+    python bench.py stats --orders 200000
+    python bench.py callbacks
+    python bench.py keyboards
+    python bench.py search --items 1000                       # FTS5 so'rov, LRU miss/hit
+    python bench.py webhook --users 200                       # in-process, soxta Bot API
+    python bench.py load --users 200 --latency 0.05 --p429 0.01   # to'liq oqimlar, ssenariy bo'yicha
+    python bench.py broadcast --customers 2000 --rate 200          # tarqatma: restart'dan davom, bloklaganlar
+    python bench.py webhook --updates rec.jsonl --url http://127.0.0.1:8080/tg --secret S   # faqat http://
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tempfile
+import collections
+from datetime import datetime
+from urllib.parse import urlsplit
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+# chat bo'yicha throttling o'lchovni buzmasin (kerak bo'lsa env orqali qaytaring)
+os.environ.setdefault("TG_CHAT_RATE", "1000")
+os.environ.setdefault("TG_CHAT_BURST", "1000")
+os.environ.setdefault("TG_GLOBAL_RATE", "100000")
+# load ssenariysida barcha buyurtmalar bitta "18:30" slotiga tushadi
+os.environ.setdefault("SLOT_CAPACITY", "1000000")
+os.environ["DB_PATH"] = os.getenv("BENCH_DB_PATH") or os.path.join(tempfile.mkdtemp(prefix="foodbot-bench-"), "bench.db")
+
+import httpx  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+
+STATUSES = ["new", "accepted", "canceled", "preparing", "onway", "delivered"]
+
+
+def fill_items(con, items=200):
+    rnd = random.Random(7)
+    con.executemany(
+        "INSERT INTO items(category,title,description,price,min_qty,max_qty,photo1_file_id,photo2_file_id,is_active,created_at)"
+        " VALUES(?,?,?,?,1,10,'p1','p2',?,?)",
+        [(rnd.choice(["food", "dessert"]), f"Item {i}", "", 10 + i % 40, int(rnd.random() > 0.2), bot.now_iso())
+         for i in range(items)],
+    )
+    con.commit()
+
+
+def fill_orders(con, n, seed, users=5000, items=200):
+    rnd = random.Random(seed)
+    batch = []
+    for i in range(n):
+        batch.append((rnd.randrange(users), rnd.randrange(1, items + 1), rnd.randint(1, 5),
+                      rnd.choices(STATUSES, weights=[2, 2, 1, 2, 2, 40])[0]))
+        if len(batch) == 50000:
+            _insert_orders(con, batch)
+            batch = []
+    if batch:
+        _insert_orders(con, batch)
+    con.execute("ANALYZE")
+    con.commit()
+
+
+def _insert_orders(con, rows):
+    ts = bot.now_iso()
+    con.executemany(
+        "INSERT INTO orders(user_id,username,full_name,item_id,qty,delivery_type,schedule_type,status,created_at,updated_at)"
+        " VALUES(?,'u','U',?,?,'address','scheduled',?,?,?)",
+        [(u, it, q, st, ts, ts) for u, it, q, st in rows],
+    )
+
+
+# (nom, sql, params, kutilgan plan bo'lagi) — bot.py dagi hot so'rovlar.
+# "SCAN orders" faqat rowid bo'yicha teskari tartib + LIMIT bo'lganda maqbul.
+QUERIES = [
+    ("cust_pick_cat", "SELECT * FROM items WHERE category=? AND is_active=1 ORDER BY id DESC", ("food",),
+     "USING INDEX idx_items_cat_active"),
+    ("admin_show_cat", "SELECT * FROM items WHERE category=? ORDER BY id DESC LIMIT 20", ("food",),
+     "USING INDEX idx_items_cat"),
+    ("orders_recent", "SELECT * FROM orders ORDER BY id DESC LIMIT 20", (), "SCAN orders"),
+    ("orders_by_status", "SELECT * FROM orders WHERE status=? AND id<? ORDER BY id DESC LIMIT 20", ("new", 1 << 62),
+     "USING INDEX idx_orders_status"),
+    ("orders_by_user", "SELECT * FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 20", (77,),
+     "USING INDEX idx_orders_user"),
+    ("count_by_status", "SELECT COUNT(*) FROM orders WHERE status=?", ("preparing",),
+     "USING COVERING INDEX idx_orders_status"),
+    ("slot_count", "SELECT COUNT(*) FROM orders WHERE scheduled_at >= ? AND scheduled_at < ? AND status != 'canceled'",
+     (1_800_000_000, 1_800_001_800), "USING COVERING INDEX idx_orders_scheduled"),
+]
+
+
+def plan_ok(plan, expected):
+    # kutilgan indeks ishlatilsin va ORDER BY uchun vaqtinchalik B-tree bo'lmasin
+    return any(expected in line for line in plan) and not any("TEMP B-TREE" in line for line in plan)
+
+
+def run_queries(con, repeat):
+    failed = False
+    for name, sql, params, expected in QUERIES:
+        plan = [r[3] for r in con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            con.execute(sql, params).fetchall()
+        us = (time.perf_counter() - t0) / repeat * 1e6
+        ok = plan_ok(plan, expected)
+        failed |= not ok
+        print(f"  {name:<18} {us:>10.1f} us/query  {'OK ' if ok else 'BAD'}  {' | '.join(plan)}")
+    return failed
+
+
+def cmd_indexes(args):
+    bot.migrate()
+    con = bot.db()
+    failed = False
+    done = 0
+    fill_items(con)
+    for target in sorted({min(args.orders, n) for n in (10_000, 100_000, args.orders)}):
+        fill_orders(con, target - done, seed=target)
+        done = target
+        print(f"orders={done:,}")
+        failed |= run_queries(con, args.repeat)
+    return 1 if failed else 0
+
+
+# ====== /stats aggregates ======
+def fill_history(con, n, days=365, seed=11, items=200):
+    # n ta buyurtma `days` kunga yoyilgan: qatorlar, yaratilish/qabul/yetkazish hodisalari bilan
+    rnd = random.Random(seed)
+    now = int(time.time())
+    base = (con.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]) + 1
+    orders, lines, events = [], [], []
+    for oid in range(base, base + n):
+        ts = now - rnd.randrange(days * 86400)
+        st = rnd.choices(["delivered", "canceled", "new"], weights=[90, 5, 5])[0]
+        item, qty, price = rnd.randrange(1, items + 1), rnd.randint(1, 4), 10 + rnd.randrange(40)
+        orders.append((oid, item, qty, st, qty * price, ts))
+        lines.append((oid, item, qty, price))
+        events.append((oid, None, "new", ts, 0))
+        if st != "new":
+            accepted = int(rnd.lognormvariate(5, 0.8))
+            events.append((oid, "new", "accepted" if st == "delivered" else "canceled", ts + accepted, accepted))
+            if st == "delivered":
+                delivered = accepted + int(rnd.lognormvariate(7.5, 0.4))
+                events.append((oid, "onway", "delivered", ts + delivered, delivered))
+    con.executemany(
+        "INSERT INTO orders(id,user_id,username,full_name,item_id,qty,delivery_type,schedule_type,status,total_price,"
+        "created_at,updated_at,created_ts) VALUES(?,1,'u','U',?,?,'address','now',?,?,'','',?)", orders)
+    con.executemany("INSERT INTO order_lines(order_id,item_id,title,qty,unit_price) VALUES(?,?,'x',?,?)", lines)
+    con.executemany(
+        "INSERT INTO order_events(order_id,from_status,to_status,created_at,ts,age) VALUES(?,?,?,'',?,?)", events)
+    con.execute("ANALYZE")
+    con.commit()
+
+
+def cmd_stats(args):
+    bot.migrate()
+    con = bot.db()
+    fill_items(con)
+    fill_history(con, args.orders)
+    print(f"orders={args.orders:,} (365 kun)")
+    for days in (1, 7, 30, 365):
+        since = int(time.time()) - days * 86400
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            st = bot._order_stats(since)
+        ms = (time.perf_counter() - t0) / args.repeat * 1e3
+        (_, acc), (_, dlv) = st["accept"], st["deliver"]
+        print(f"  {days:>3} kun  {ms:>8.2f} ms  orders={st['hourly']['total']:<7} "
+              f"accept p50/p95={acc[0]}/{acc[1]}s  deliver p50/p95={dlv[0]}/{dlv[1]}s")
+    return 0
+
+
+# ====== Callback dispatch ======
+VALID_CALLBACKS = [
+    "cust:cancel", "cust:cat:food", "cust:page:dessert:3", "cust:item:1234", "cust:qty:7", "cust:qty:next",
+    "cust:sched:scheduled", "admin:add:start", "admin:add:cat:food", "admin:cat:dessert", "admin:icat:food:120",
+    "admin:item:55", "admin:toggle:55", "admin:orders", "admin:ord:new:today:b9000", "admin:od:9000:all:week",
+    "admin:st:9000:preparing", "admin:edit:55:minmax",
+]
+MALFORMED_CALLBACKS = [
+    "", "x", "cust", "cust:item:abc", "cust:item:", "cust:page:food", "cust:cat:pizza", "cust:qty:-1",
+    "admin:st:1:bogus", "admin:st:1", "admin:ord:all:all:c5", "admin:edit:5:price:extra", "zzz:yyy:xxx",
+    "cust:item:²", "cust:qty:¹", "admin:ord:all:all:b²", "admin:od:٣:all:week",
+]
+
+_LEGACY_PREFIXES = [
+    "cust:cat:", "cust:page:", "cust:item:", "cust:qty:", "cust:sched:", "admin:add:cat:", "admin:cat:",
+    "admin:icat:", "admin:item:", "admin:toggle:", "admin:ord:", "admin:od:", "admin:st:", "admin:edit:",
+]
+
+
+SEARCH_WORDS = ["palov", "osh", "lag'mon", "manti", "somsa", "shashlik", "norin", "chuchvara", "mastava", "sho'rva",
+                "qozon", "kabob", "go'sht", "tovuq", "tort", "medovik", "napoleon", "chak-chak", "holva", "pishiriq"]
+SEARCH_QUERIES = ["pal", "lagmon", "lag‘mon", "osh", "tort medovik", "go'sht kabob", "q", "xyz", ""]
+
+
+def cmd_search(args):
+    bot.migrate()
+    con = bot.db()
+    rnd = random.Random(5)
+    con.executemany(
+        "INSERT INTO items(category,title,description,price,photo1_file_id,photo2_file_id,created_at)"
+        " VALUES(?,?,?,?,'p1','p2',?)",
+        [(rnd.choice(["food", "dessert"]), " ".join(rnd.sample(SEARCH_WORDS, 2)).capitalize(),
+          " ".join(rnd.sample(SEARCH_WORDS, 5)), 10 + i % 40, bot.now_iso()) for i in range(args.items)],
+    )
+    con.commit()
+    bot.catalog.load()
+    search = bot.menu_search
+
+    async def run():
+        print(f"{args.items} items, {args.repeat} repeats; miss = reader pool + FTS, hit = LRU")
+        print(f"  {'query':<16}{'matches':>8}{'sql':>10}{'miss':>10}{'hit':>10}")
+        for q in SEARCH_QUERIES:
+            match = bot.fts_query(q)
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                if match:
+                    bot._fetchall("SELECT rowid FROM items_fts WHERE items_fts MATCH ? ORDER BY rank LIMIT ?",
+                                  (match, bot.SEARCH_MAX))
+            sql = (time.perf_counter() - t0) / args.repeat
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                search.cache.clear()
+                ids = await search.ids(q)
+            miss = (time.perf_counter() - t0) / args.repeat
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                await search.ids(q)
+            hit = (time.perf_counter() - t0) / args.repeat
+            print(f"  {q or '(bo‘sh)':<16}{len(ids):>8}{sql * 1e6:>8.0f}us{miss * 1e6:>8.0f}us{hit * 1e6:>8.1f}us")
+
+    asyncio.run(run())
+    return 0
+
+
+def legacy_dispatch(data):
+    # eski callback_router: startswith zanjiri, keyin handler ichida split/int
+    if data in ("cust:cancel", "admin:add:start", "admin:orders"):
+        return data
+    for p in _LEGACY_PREFIXES:
+        if data.startswith(p):
+            parts = data.split(":")
+            if p in ("cust:item:", "admin:item:", "admin:toggle:"):
+                int(parts[-1])
+            elif p in ("admin:st:", "admin:od:"):
+                int(parts[2])
+            return p
+    return None
+
+
+def time_per_call(fn, samples, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for d in samples:
+            fn(d)
+    return (time.perf_counter() - t0) / (repeat * len(samples)) * 1e9
+
+
+def cmd_callbacks(args):
+    for d in VALID_CALLBACKS:
+        assert bot.parse_callback(d) is not None, d
+    for d in MALFORMED_CALLBACKS:
+        assert bot.parse_callback(d) is None, d
+
+    legacy_errors = 0
+    for d in MALFORMED_CALLBACKS:
+        try:
+            legacy_dispatch(d)
+        except ValueError:
+            legacy_errors += 1
+
+    def legacy_safe(d):
+        try:
+            legacy_dispatch(d)
+        except ValueError:
+            pass
+
+    cold = bot.parse_callback.__wrapped__
+    print(f"parse_callback   valid:     {time_per_call(cold, VALID_CALLBACKS, args.repeat):7.0f} ns/dispatch (uncached)")
+    print(f"parse_callback   malformed: {time_per_call(cold, MALFORMED_CALLBACKS, args.repeat):7.0f} ns/dispatch"
+          " (uncached, 0 exceptions)")
+    print(f"parse_callback   valid:     {time_per_call(bot.parse_callback, VALID_CALLBACKS, args.repeat):7.0f} ns/dispatch (LRU hit)")
+    print(f"legacy chain     valid:     {time_per_call(legacy_dispatch, VALID_CALLBACKS, args.repeat):7.0f} ns/dispatch")
+    print(f"legacy chain     malformed: {time_per_call(legacy_safe, MALFORMED_CALLBACKS, args.repeat):7.0f} ns/dispatch"
+          f" ({legacy_errors}/{len(MALFORMED_CALLBACKS)} raise)")
+    return 0
+
+
+# ====== Keyboards ======
+def alloc_per_call(fn, n):
+    # tracemalloc: bitta chaqiruvda ajratilgan bloklar soni va baytlar
+    import tracemalloc
+    fn()
+    tracemalloc.start()
+    snap0 = tracemalloc.take_snapshot()
+    keep = [fn() for _ in range(n)]
+    stats = tracemalloc.take_snapshot().compare_to(snap0, "filename")
+    tracemalloc.stop()
+    del keep
+    blocks = sum(s.count_diff for s in stats if s.count_diff > 0)
+    size = sum(s.size_diff for s in stats if s.size_diff > 0)
+    return blocks / n, size / n
+
+
+def cmd_keyboards(args):
+    cases = [
+        ("kb_admin_main", bot.kb_admin_main, lambda: bot.KB_ADMIN_MAIN),
+        ("kb_categories", bot.kb_categories, lambda: bot.KB_CATEGORIES),
+        ("kb_delivery_reply", bot.kb_delivery_reply, lambda: bot.KB_DELIVERY_REPLY),
+        ("kb_qty(1,10,5)", lambda: bot.kb_qty.__wrapped__(1, 10, 5), lambda: bot.kb_qty(1, 10, 5)),
+        ("kb_order_status", lambda: bot.kb_order_status.__wrapped__(4242, "new"), lambda: bot.kb_order_status(4242, "new")),
+    ]
+    print(f"{'keyboard':<20} {'build us':>9} {'blocks':>7} {'bytes':>7}   {'cached us':>9} {'blocks':>7} {'bytes':>7}")
+    for name, build, cached in cases:
+        b_us = time_per_call(lambda _: build(), [None], args.repeat) / 1e3
+        c_us = time_per_call(lambda _: cached(), [None], args.repeat) / 1e3
+        b_blk, b_size = alloc_per_call(build, 200)
+        c_blk, c_size = alloc_per_call(cached, 200)
+        print(f"{name:<20} {b_us:>9.2f} {b_blk:>7.0f} {b_size:>7.0f}   {c_us:>9.2f} {c_blk:>7.0f} {c_size:>7.0f}")
+    print("kb_qty LRU:", bot.kb_qty.cache_info())
+    return 0
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# ====== Soxta Bot API ======
+class FakeBotApi(BaseRequest):
+    """Bot API o'rnini bosadi: har bir chaqiruvni yozib boradi, chatga yozilganda on_chat() chaqiriladi.
+    latency — o'rtacha javob vaqti (s, ±50%); p429 — chatga yozishlarning qancha qismi 429 qaytaradi;
+    blocked — botni bloklagan chat'lar (403)."""
+
+    def __init__(self, on_chat=None, latency=0.0, p429=0.0, retry_after=1, blocked=()):
+        self.on_chat = on_chat
+        self.latency = latency
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.blocked = blocked
+        self.calls = {}
+        self.throttled = 0
+        self.forbidden = 0
+        self._mid = itertools.count(1)
+        self._rnd = random.Random(3)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (0.5 + self._rnd.random()))
+        chat_id = params.get("chat_id")
+        if chat_id is not None and self.p429 and self._rnd.random() < self.p429:
+            self.throttled += 1
+            return 429, json.dumps({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }).encode()
+        if chat_id is not None and int(chat_id) in self.blocked:
+            self.forbidden += 1
+            return 403, json.dumps({
+                "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+            }).encode()
+        if chat_id is not None and self.on_chat:
+            self.on_chat(int(chat_id), endpoint)
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if endpoint.startswith(("send", "edit")):
+            chat_id = int(params.get("chat_id", 0))
+            msg = {"message_id": next(self._mid), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            return [msg, msg] if endpoint == "sendMediaGroup" else msg
+        return True
+
+
+def bench_builder(api):
+    return Application.builder().request(api).get_updates_request(FakeBotApi())
+
+
+def seed_menu(n=20):
+    con = bot.db()
+    if con.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0:
+        fill_items(con, n)
+    bot.catalog.load()
+    bot.staff.load()
+
+
+# ====== Sintetik update'lar ======
+_update_ids = itertools.count(1)
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"u{uid}"}
+
+
+def upd_text(uid, text):
+    m = {"message_id": next(_update_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+         "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": m}
+
+
+def upd_callback(uid, data):
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": str(next(_update_ids)), "from": _user(uid), "chat_instance": str(uid), "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bench"}, "text": "menu"}}}
+
+
+def browse_session(uid):
+    return [upd_text(uid, "/start"), upd_callback(uid, "cust:cat:food"), upd_callback(uid, "cust:page:food:1"),
+            upd_callback(uid, "cust:page:food:0")]
+
+
+def update_chat_id(u):
+    body = u.get("message") or u.get("callback_query", {}).get("message") or {}
+    return body.get("chat", {}).get("id")
+
+
+def load_sessions(path):
+    # JSONL -> chat bo'yicha ketma-ketliklar (bitta chat ichida tartib saqlanadi)
+    sessions = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                u = json.loads(line)
+                sessions.setdefault(update_chat_id(u), []).append(u)
+    return list(sessions.values())
+
+
+class KeepAliveConn:
+    """Minimal HTTP/1.1 keep-alive client: har bir sessiya o'z ulanishida (httpx pool'i o'lchovni buzadi)."""
+
+    def __init__(self, url):
+        u = urlsplit(url)
+        self.host, self.port, self.path = u.hostname, u.port or 80, u.path or "/"
+        self.reader = self.writer = None
+
+    async def post(self, payload, headers):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode()
+        head = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        self.writer.write(
+            f"POST {self.path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n{head}\r\n".encode() + body
+        )
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while (h := await self.reader.readline()) not in (b"\r\n", b""):
+            k, _, v = h.decode().partition(":")
+            if k.lower() == "content-length":
+                length = int(v)
+        await self.reader.readexactly(length)
+        if status != 200:
+            raise RuntimeError(f"webhook HTTP {status}")
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+async def post_sessions(url, secret, sessions, wait_reply=None):
+    # har bir chat o'z update'larini ketma-ket yuboradi, chatlar parallel
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    acks, e2e = [], []
+
+    async def one(session):
+        conn = KeepAliveConn(url)
+        try:
+            for u in session:
+                chat_id = update_chat_id(u)
+                ev = wait_reply(chat_id) if wait_reply else None
+                t0 = time.perf_counter()
+                await conn.post(u, headers)
+                acks.append(time.perf_counter() - t0)
+                if ev is not None:
+                    await asyncio.wait_for(ev.wait(), timeout=10)
+                    e2e.append(time.perf_counter() - t0)
+        finally:
+            conn.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(s) for s in sessions))
+    return time.perf_counter() - t0, acks, e2e
+
+
+def report(title, elapsed, n, series):
+    print(f"{title}: {n} updates in {elapsed:.2f}s -> {n / elapsed:.0f} upd/s")
+    for name, values in series.items():
+        if values:
+            print(f"  {name:<8} p50={pct(values, 50) * 1e3:.2f}ms p99={pct(values, 99) * 1e3:.2f}ms "
+                  f"max={max(values) * 1e3:.2f}ms")
+
+
+async def webhook_inprocess(args, sessions):
+    waiters = {}
+
+    def on_chat(chat_id, endpoint):
+        ev = waiters.pop(chat_id, None)
+        if ev:
+            ev.set()
+
+    def wait_reply(chat_id):
+        ev = waiters[chat_id] = asyncio.Event()
+        return ev
+
+    api = FakeBotApi(on_chat)
+    app = bot.build_app(bench_builder(api))
+    server = bot.webhook_server(app, host="127.0.0.1", port=0, path="/tg", secret="bench")
+    async with bot.running(app):
+        await server.start()
+        async with httpx.AsyncClient() as client:
+            health = await client.get(f"http://127.0.0.1:{server.port}/healthz")
+            print("healthz:", health.status_code, health.text)
+        elapsed, acks, e2e = await post_sessions(f"http://127.0.0.1:{server.port}/tg", "bench", sessions, wait_reply)
+        await server.stop()
+    report("webhook (in-process)", elapsed, len(acks), {"ack": acks, "e2e": e2e})
+    print("  bot api calls:", dict(sorted(api.calls.items())))
+
+
+def cmd_webhook(args):
+    if args.updates:
+        sessions = load_sessions(args.updates)
+    else:
+        sessions = [browse_session(uid) for uid in range(1000, 1000 + args.users)]
+    if args.save:
+        with open(args.save, "w") as f:
+            for u in itertools.chain.from_iterable(sessions):
+                f.write(json.dumps(u) + "\n")
+
+    if args.url:
+        async def external():
+            elapsed, acks, _ = await post_sessions(args.url, args.secret, sessions)
+            report(f"webhook {args.url}", elapsed, len(acks), {"ack": acks})
+        asyncio.run(external())
+        return 0
+
+    bot.migrate()
+    seed_menu()
+    asyncio.run(webhook_inprocess(args, sessions))
+    return 0
+
+
+# ====== Yetkazish vaqti: parse_schedule regressiyalari ======
+# "hozir" — 2026-10-17 (shanba) 17:00, BOT_TZ. Kutilgan natija: "YYYY-MM-DD HH:MM" yoki None
+SCHEDULE_NOW = (2026, 10, 17, 17, 0)
+SCHEDULE_CASES = [
+    ("18:30", "2026-10-17 18:30"),
+    ("17:10", "2026-10-17 17:10"),          # juda yaqin: ertaga emas — book_slot rad etib slot taklif qiladi
+    ("16:59", "2026-10-18 16:59"),          # bugun o'tib ketgan -> ertaga
+    ("09:00", "2026-10-18 09:00"),
+    ("9.15", "2026-10-18 09:15"),
+    ("Bugun 20:00", "2026-10-17 20:00"),
+    ("bugun soat 12", "2026-10-17 12:00"),  # aniq kun: o'tgan bo'lsa ham o'zgartirilmaydi
+    ("ertaga soat 9", "2026-10-18 09:00"),
+    ("soat 20", "2026-10-17 20:00"),
+    ("Ertaga   13:00", "2026-10-18 13:00"),
+    ("эртага 19:30", "2026-10-18 19:30"),
+    ("послезавтра 10.30", "2026-10-19 10:30"),
+    ("25.12 18:30", "2026-12-25 18:30"),
+    ("01.01 10:00", "2027-01-01 10:00"),    # o'tgan sana -> keyingi yil
+    ("31.02 10:00", None),
+    ("32.01 10:00", None),
+    ("24:00", None),
+    ("18:60", None),
+    ("12", None),                           # "soat"siz yolg'iz son — vaqt emas
+    ("soat", None),
+    ("kecha 18:00", None),
+    ("", None),
+]
+
+
+def cmd_schedule(args):
+    now = datetime(*SCHEDULE_NOW, tzinfo=bot.BOT_TZ)
+    bad = 0
+    for text, want in SCHEDULE_CASES:
+        ts = bot.parse_schedule(text, now)
+        got = f"{datetime.fromtimestamp(ts, bot.BOT_TZ):%Y-%m-%d %H:%M}" if ts is not None else None
+        ok = got == want
+        bad += not ok
+        print(f"  {'OK ' if ok else 'BAD'} {text!r:<22} -> {got}" + ("" if ok else f"  (kutilgan {want})"))
+    print(f"{len(SCHEDULE_CASES) - bad}/{len(SCHEDULE_CASES)} OK")
+    return 1 if bad else 0
+
+
+# ====== Load test: to'liq oqimlar ======
+LOAD_USER_BASE = 100_000
+
+
+def order_when():
+    # soatga bog'liq bo'lmagan vaqt: minimal muddatdan 1 soat keyin, aniq sana bilan ("25.12 18:30")
+    when = datetime.fromtimestamp(time.time() + bot.SCHEDULE_MIN_LEAD + 3600, bot.BOT_TZ)
+    return f"{when:%d.%m %H:%M}"
+
+
+def order_session(uid, item_id, when):
+    # menyu -> mahsulot -> savat -> checkout -> manzil -> aloqa -> vaqt -> finalize
+    return [upd_text(uid, "/start"), upd_callback(uid, "cust:cat:food"), upd_callback(uid, f"cust:item:{item_id}"),
+            upd_callback(uid, "cust:qty:next"), upd_callback(uid, "cust:checkout"), upd_text(uid, "Ko'cha 1"),
+            upd_text(uid, f"@u{uid}"), upd_callback(uid, "cust:sched:scheduled"), upd_text(uid, when)]
+
+
+ADMIN_FLOW = [("new", "accepted"), ("accepted", "preparing"), ("preparing", "onway"), ("onway", "delivered")]
+
+
+class LoadRun:
+    """Bitta ssenariy: yangi Application, update'lar to'g'ridan-to'g'ri update_queue'ga.
+    Har qadam keyingi chatga (kutilgan endpoint'ga) javob kelguncha o'lchanadi."""
+
+    def __init__(self, args):
+        self.args = args
+        self.waiters = {}  # chat_id -> (event, kutilgan endpoint'lar yoki None)
+        self.api = FakeBotApi(self.on_chat, latency=args.latency, p429=args.p429, retry_after=args.retry_after)
+        self.app = bot.build_app(bench_builder(self.api))
+        self.latencies = []
+        self.lost = {}  # qadam turi -> yo'qolganlar soni
+        self.steps = 0
+        self.replies = collections.Counter()  # chat_id -> botdan kelgan xabarlar
+
+    def on_chat(self, chat_id, endpoint):
+        self.replies[chat_id] += 1
+        w = self.waiters.get(chat_id)
+        if w and (w[1] is None or endpoint in w[1]):
+            del self.waiters[chat_id]
+            w[0].set()
+
+    async def step(self, u, expect=None):
+        chat_id = update_chat_id(u)
+        ev = asyncio.Event()
+        self.waiters[chat_id] = (ev, expect)
+        t0 = time.perf_counter()
+        await self.app.update_queue.put(Update.de_json(u, self.app.bot))
+        self.steps += 1
+        try:
+            await asyncio.wait_for(ev.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            # javob kelmadi: update yo'qolgan yoki suhbat holati kutilgandan boshqa
+            self.waiters.pop(chat_id, None)
+            kind = u["callback_query"]["data"].rsplit(":", 1)[0] if "callback_query" in u else u["message"]["text"][:12]
+            self.lost[kind] = self.lost.get(kind, 0) + 1
+            return False
+        self.latencies.append(time.perf_counter() - t0)
+        return True
+
+    async def session(self, updates):
+        for u in updates:
+            if not await self.step(u):
+                return
+            if self.args.think:
+                await asyncio.sleep(self.args.think)
+
+    async def admin(self, customers_done):
+        # bitta admin yangi buyurtmalarni oxirigacha olib boradi, mijozlar tugab navbat bo'shaguncha
+        aid = bot.ADMIN_ID
+        await self.step(upd_text(aid, "/start"))
+        while True:
+            rows = await bot.run_read(bot._fetchall, "SELECT id FROM orders WHERE status='new' ORDER BY id LIMIT 50")
+            if not rows:
+                if customers_done.is_set():
+                    return
+                await asyncio.sleep(0.05)
+                continue
+            for r in rows:
+                for from_st, to_st in ADMIN_FLOW:
+                    await self.step(upd_callback(aid, f"admin:mv:{r['id']}:{from_st}:{to_st}"),
+                                    expect=("editMessageReplyMarkup",))
+
+
+    async def flood(self, n):
+        # bitta chatdan n ta /start birdaniga: boshqa chatlar bunga qaramay javob olishi kerak.
+        # -> shu chatning navbati tugagan vaqt, s
+        uid = FLOOD_USER
+        t0 = time.perf_counter()
+        for _ in range(n):
+            await self.app.update_queue.put(Update.de_json(upd_text(uid, "/start"), self.app.bot))
+        while self.replies[uid] < n:
+            await asyncio.sleep(0.01)
+        return time.perf_counter() - t0
+
+
+FLOOD_USER = LOAD_USER_BASE - 1
+
+
+def load_sessions_for(scenario, users):
+    items = [it.id for it in bot.catalog.active("food")]
+    uids = range(LOAD_USER_BASE, LOAD_USER_BASE + users)
+    if scenario in ("browse", "flood"):
+        return [browse_session(uid) for uid in uids]
+    if scenario in ("order", "mixed"):
+        when = order_when()
+        return [order_session(uid, items[uid % len(items)], when) for uid in uids]
+    return []
+
+
+async def load_scenario(scenario, args):
+    run = LoadRun(args)
+    bot.metrics = bot.Metrics()
+    w0 = bot.order_writer.snapshot()
+    orders0 = bot.db().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    done = asyncio.Event()
+    async with bot.running(run.app):
+        t0 = time.perf_counter()
+        admin = asyncio.create_task(run.admin(done)) if scenario in ("admin", "mixed") else None
+        flood = asyncio.create_task(run.flood(args.flood)) if scenario == "flood" else None
+        if flood:
+            await asyncio.sleep(0)  # flood navbatga birinchi tushadi
+        await asyncio.gather(*(run.session(s) for s in load_sessions_for(scenario, args.users)))
+        others = time.perf_counter() - t0
+        done.set()
+        if admin:
+            await admin
+        if flood:
+            drained = await asyncio.wait_for(flood, 300)
+        elapsed = time.perf_counter() - t0
+    w1 = bot.order_writer.snapshot()
+    orders = bot.db().execute("SELECT COUNT(*) FROM orders").fetchone()[0] - orders0
+
+    report(f"[{scenario}]", elapsed, run.steps, {"step": run.latencies})
+    print(f"  lost steps={sum(run.lost.values())} {run.lost or ''}  orders={orders}  api calls={sum(run.api.calls.values())} "
+          f"429s={run.api.throttled}")
+    if flood:
+        # chat ichida ketma-ket, chatlar orasida parallel: boshqa sessiyalar flood'dan oldin tugaydi
+        print(f"  flood: 1 chat x {args.flood} /start drained in {drained:.2f}s; "
+              f"other chats done in {others:.2f}s, max step={max(run.latencies, default=0) * 1e3:.0f}ms")
+    for name in ("db_wait_seconds", "db_exec_seconds"):
+        rows = ", ".join(f"{label} n={n} mean={mean * 1e3:.2f}ms p95<={p95 * 1e3:g}ms"
+                         for label, n, mean, p95 in bot.metrics.top(name, 2))
+        print(f"  {name:<16} {rows or '-'}")
+    batches = w1["write_batches"] - w0["write_batches"]
+    ops = w1["write_ops"] - w0["write_ops"]
+    print(f"  write batches={batches} ops={ops} avg batch={ops / batches if batches else 0:.1f} "
+          f"db errors={bot.metrics.total('db_errors_total')} handler errors={bot.metrics.total('handler_errors_total')}")
+    # har bir buyurtma sessiyasi haqiqatan buyurtma yaratgan bo'lishi kerak (slot taklifi javob emas)
+    expected = args.users if scenario in ("order", "mixed") else 0
+    if orders != expected:
+        print(f"  !! orders={orders}, kutilgan {expected}")
+    return sum(run.lost.values()) + abs(orders - expected)
+
+
+def cmd_load(args):
+    bot.migrate()
+    seed_menu()
+    scenarios = ["browse", "order", "admin", "mixed", "flood"] if args.scenario == "all" else [args.scenario]
+    lost = 0
+    for sc in scenarios:
+        lost += asyncio.run(load_scenario(sc, args))
+    return 1 if lost else 0
+
+
+# ====== Broadcast: restart'dan davom etish ======
+BROADCAST_USER_BASE = 500_000
+
+
+def fill_customers(con, n):
+    ts = int(time.time())
+    con.executemany(
+        "INSERT OR IGNORE INTO customers(user_id,username,full_name,first_seen,last_seen) VALUES(?,?,?,?,?)",
+        [(BROADCAST_USER_BASE + i, f"u{i}", f"User {i}", ts, ts) for i in range(n)],
+    )
+    con.commit()
+
+
+async def broadcast_once(api, stop_after=None, text=None):
+    # text berilsa yangi tarqatma boshlanadi, aks holda on_startup tugamaganini davom ettiradi.
+    # stop_after: shuncha yetkazilgach ilova to'xtatiladi (restart simulyatsiyasi). -> (bc_id, sekund)
+    app = bot.build_app(bench_builder(api))
+    async with bot.running(app):
+        t0 = time.perf_counter()
+        if text:
+            bot.start_broadcast(app, await bot.repo.create_broadcast(text, int(os.environ["ADMIN_ID"])))
+        bc_id = app.bot_data["broadcast"][0].id
+        while "broadcast" in app.bot_data:
+            if stop_after and api.delivered >= stop_after:
+                break
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - t0
+    return bc_id, elapsed
+
+
+async def broadcast_bench(args, blocked):
+    delivered = collections.Counter()
+
+    def on_chat(chat_id, endpoint):
+        if endpoint == "sendMessage" and chat_id >= BROADCAST_USER_BASE:
+            delivered[chat_id] += 1
+            api.delivered += 1
+
+    api = FakeBotApi(on_chat, latency=args.latency, blocked=blocked)
+    api.delivered = 0
+    bc_id, t1 = await broadcast_once(api, stop_after=args.customers // 2, text="📣 Aksiya! Bugun barcha shirinliklarga -20%")
+    cp = bot.db().execute("SELECT last_user_id, sent, blocked FROM broadcasts WHERE id=?", (bc_id,)).fetchone()
+    _, t2 = await broadcast_once(api)
+    row = bot.db().execute("SELECT * FROM broadcasts WHERE id=?", (bc_id,)).fetchone()
+
+    dup = sum(c - 1 for c in delivered.values())
+    missing = args.customers - len(blocked) - len(delivered)
+    print(f"[broadcast] customers={args.customers} blocked={len(blocked)} rate={args.rate}/s chunk={args.chunk}")
+    print(f"  1-ishga tushish: {t1:.2f}s, checkpoint user_id={cp['last_user_id']} sent={cp['sent']} blocked={cp['blocked']}")
+    print(f"  2-ishga tushish (davom): {t2:.2f}s -> status={row['status']} sent={row['sent']} blocked={row['blocked']} "
+          f"failed={row['failed']}")
+    print(f"  throughput={row['sent'] / (t1 + t2):.0f} msg/s  duplicates={dup}  missing={missing}")
+
+    # ikkinchi tarqatma bloklaganlarni umuman chaqirmaydi
+    forbidden0 = api.forbidden
+    bc2, t3 = await broadcast_once(api, text="Ikkinchi xabar")
+    row2 = bot.db().execute("SELECT * FROM broadcasts WHERE id=?", (bc2,)).fetchone()
+    print(f"  2-tarqatma: total={row2['total']} sent={row2['sent']} 403s={api.forbidden - forbidden0} {t3:.2f}s")
+    return 1 if dup or missing or row["status"] != "done" or api.forbidden != forbidden0 else 0
+
+
+def cmd_broadcast(args):
+    bot.migrate()
+    seed_menu()
+    fill_customers(bot.db(), args.customers)
+    rnd = random.Random(9)
+    blocked = {BROADCAST_USER_BASE + i for i in range(args.customers) if rnd.random() < args.blocked}
+    bot.BROADCAST_RATE = args.rate
+    bot.BROADCAST_CHUNK = args.chunk
+    return asyncio.run(broadcast_bench(args, blocked))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    sp = sub.add_parser("indexes", help="query plan'lar indeks bo'yicha qolishini tekshiradi")
+    sp.add_argument("--orders", type=int, default=1_000_000)
+    sp.add_argument("--repeat", type=int, default=200)
+    sp.set_defaults(fn=cmd_indexes)
+
+    sp = sub.add_parser("stats", help="/stats agregatlari bir yillik tarixda")
+    sp.add_argument("--orders", type=int, default=200_000)
+    sp.add_argument("--repeat", type=int, default=5)
+    sp.set_defaults(fn=cmd_stats)
+
+    sp = sub.add_parser("callbacks", help="callback_data dispatch narxi (parse + tekshirish)")
+    sp.add_argument("--repeat", type=int, default=20000)
+    sp.set_defaults(fn=cmd_callbacks)
+
+    sp = sub.add_parser("keyboards", help="klaviaturalarni qurish vs kesh: vaqt va allokatsiyalar")
+    sp.add_argument("--repeat", type=int, default=5000)
+    sp.set_defaults(fn=cmd_keyboards)
+
+    sp = sub.add_parser("search", help="menyu qidiruvi: FTS5 so'rovi va LRU kesh")
+    sp.add_argument("--items", type=int, default=1000)
+    sp.add_argument("--repeat", type=int, default=200)
+    sp.set_defaults(fn=cmd_search)
+
+    sp = sub.add_parser("schedule", help="parse_schedule: yetkazish vaqti matnlari bo'yicha regressiya jadvali")
+    sp.set_defaults(fn=cmd_schedule)
+
+    sp = sub.add_parser("webhook", help="yozib olingan/sintetik update'larni webhook'ga yuboradi")
+    sp.add_argument("--updates", help="Update JSON qatorlari (JSONL)")
+    sp.add_argument("--users", type=int, default=100, help="sintetik browse sessiyalari soni")
+    sp.add_argument("--url", help="tashqi webhook URL; berilmasa bot shu jarayonda ishga tushadi")
+    sp.add_argument("--secret", default="")
+    sp.add_argument("--save", help="sintetik update'larni JSONL'ga yozish")
+    sp.set_defaults(fn=cmd_webhook)
+
+    sp = sub.add_parser("load", help="build_app() ilovasi bo'yicha yuk testi: browse/order/admin ssenariylari")
+    sp.add_argument("--scenario", choices=["browse", "order", "admin", "mixed", "flood", "all"], default="all")
+    sp.add_argument("--users", type=int, default=200)
+    sp.add_argument("--latency", type=float, default=0.05, help="soxta Bot API o'rtacha javob vaqti, s")
+    sp.add_argument("--p429", type=float, default=0.0, help="chatga yozishlarda 429 ehtimoli")
+    sp.add_argument("--retry-after", type=int, default=1)
+    sp.add_argument("--think", type=float, default=0.0, help="mijoz qadamlari orasidagi pauza, s")
+    sp.add_argument("--timeout", type=float, default=10.0, help="bitta qadam javobini kutish, s")
+    sp.add_argument("--flood", type=int, default=600, help="flood ssenariysida bitta chatdan /start soni")
+    sp.set_defaults(fn=cmd_load)
+
+    sp = sub.add_parser("broadcast", help="/broadcast: tezlik, checkpoint'dan davom etish, bloklaganlar")
+    sp.add_argument("--customers", type=int, default=2000)
+    sp.add_argument("--blocked", type=float, default=0.05, help="botni bloklagan mijozlar ulushi")
+    sp.add_argument("--rate", type=float, default=200, help="BROADCAST_RATE, msg/s")
+    sp.add_argument("--chunk", type=int, default=200, help="BROADCAST_CHUNK")
+    sp.add_argument("--latency", type=float, default=0.05)
+    sp.set_defaults(fn=cmd_broadcast)
+
+    args = p.parse_args()
+    sys.exit(args.fn(args))
+
+
+if __name__ == "__main__":
+    main()
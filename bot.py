@@ -1,7 +1,26 @@
 import os
+import re
+import hmac
+import html
+import json
+import contextlib
+import collections
+import signal
 import sqlite3
+import asyncio
 import logging
-from datetime import datetime
+import operator
+import heapq
+import bisect
+import functools
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, date, time as dtime
+from zoneinfo import ZoneInfo
+from typing import NamedTuple
+from urllib.parse import urlsplit
 
 from telegram import (
     Update,
@@ -10,15 +29,24 @@ from telegram import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     InputMediaPhoto,
+    InlineQueryResultCachedPhoto,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
+    InlineQueryHandler,
+    TypeHandler,
     ContextTypes,
+    BaseRateLimiter,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     filters,
 )
 
@@ -34,16 +62,331 @@ if not BOT_TOKEN:
 if not ADMIN_ID:
     raise RuntimeError("ADMIN_ID env yo'q (sizning Telegram ID)")
 
+# ====== Metrics ======
+# Handler, DB va Bot API vaqtlari uchun gistogramma/counter'lar. /metrics (Prometheus matn
+# formati) METRICS_PORT berilsa lokal HTTP serverda; qisqa ko'rinish — admin /perf.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — o'chiq
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # oxirgisi: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def quantile(self, q):
+        # bucket yuqori chegarasi bo'yicha taxmin
+        need, acc = q * self.count, 0
+        for bound, c in zip(LATENCY_BUCKETS + (float("inf"),), self.counts):
+            acc += c
+            if acc >= need:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """Nom -> {label qiymati -> Histogram/int}. DB thread'laridan ham chaqiriladi, shuning uchun lock."""
+
+    # metrika nomi -> (label kaliti, tavsif)
+    HELP = {
+        "handler_seconds": ("handler", "Update handler latency"),
+        "handler_errors_total": ("handler", "Handler exceptions"),
+        "db_query_seconds": ("query", "Repo query latency incl. executor wait"),
+        "db_exec_seconds": ("pool", "SQL execution time on DB threads"),
+        "db_wait_seconds": ("pool", "DB executor queue wait"),
+        "db_errors_total": ("pool", "DB exceptions"),
+        "api_seconds": ("method", "Bot API round-trip time"),
+        "api_queue_seconds": ("method", "Wait in the outbound rate limiter"),
+        "api_errors_total": ("method", "Bot API errors"),
+        "api_retry_after_total": ("method", "Bot API RetryAfter (429) responses"),
+        "broadcast_messages_total": ("result", "Broadcast deliveries by outcome"),
+    }
+
+    def __init__(self):
+        self.hist = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, label, v):
+        with self._lock:
+            h = self.hist.setdefault(name, {}).get(label)
+            if h is None:
+                h = self.hist[name][label] = Histogram()
+            h.observe(v)
+
+    def inc(self, name, label, n=1):
+        with self._lock:
+            d = self.counters.setdefault(name, {})
+            d[label] = d.get(label, 0) + n
+
+    def top(self, name, n):
+        # -> [(label, soni, o'rtacha, p95)] umumiy vaqt bo'yicha kamayish tartibida
+        with self._lock:
+            rows = sorted(self.hist.get(name, {}).items(), key=lambda kv: kv[1].sum, reverse=True)[:n]
+            return [(label, h.count, h.sum / h.count, h.quantile(0.95)) for label, h in rows]
+
+    def total(self, name):
+        with self._lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def render(self, gauges=()):
+        # Prometheus text exposition format
+        out = []
+        with self._lock:
+            for name, series in sorted(self.hist.items()):
+                key, doc = self.HELP[name]
+                out += [f"# HELP foodbot_{name} {doc}", f"# TYPE foodbot_{name} histogram"]
+                for label, h in sorted(series.items()):
+                    acc = 0
+                    for bound, c in zip(LATENCY_BUCKETS + ("+Inf",), h.counts):
+                        acc += c
+                        out.append(f'foodbot_{name}_bucket{{{key}="{label}",le="{bound}"}} {acc}')
+                    out.append(f'foodbot_{name}_sum{{{key}="{label}"}} {h.sum:.6f}')
+                    out.append(f'foodbot_{name}_count{{{key}="{label}"}} {h.count}')
+            for name, series in sorted(self.counters.items()):
+                key, doc = self.HELP[name]
+                out += [f"# HELP foodbot_{name} {doc}", f"# TYPE foodbot_{name} counter"]
+                out += [f'foodbot_{name}{{{key}="{label}"}} {v}' for label, v in sorted(series.items())]
+        for name, v in gauges:
+            out += [f"# TYPE foodbot_{name} gauge", f"foodbot_{name} {v}"]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def timed_handler(name, fn):
+    # PTB'da middleware yo'q: handler callback'lari build paytida shu bilan o'raladi
+    @functools.wraps(fn)
+    async def wrapper(update, context, *args):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context, *args)
+        except Exception:
+            metrics.inc("handler_errors_total", name)
+            raise
+        finally:
+            metrics.observe("handler_seconds", name, time.perf_counter() - t0)
+    return wrapper
+
 # ====== DB ======
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# SQL hech qachon event loop'da bajarilmaydi: bitta yozuvchi thread (SQLite baribir
+# bitta writer'ga ruxsat beradi) va WAL tufayli yozuvni kutmaydigan o'quvchilar pool'i.
+DB_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+DB_READ_EXECUTOR = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-read")
+
+_db_local = threading.local()
+
 def db():
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
+    # Har bir thread o'z doimiy ulanishini qayta ishlatadi (yopilmaydi).
+    con = getattr(_db_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(DB_PATH, cached_statements=256)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA busy_timeout=5000")
+        _db_local.con = con
     return con
 
-def init_db():
+def _timed_job(pool, queued, fn, args):
+    # DB thread'ida: navbatda kutish va bajarilish vaqti alohida
+    start = time.perf_counter()
+    metrics.observe("db_wait_seconds", pool, start - queued)
+    try:
+        return fn(*args)
+    except Exception:
+        metrics.inc("db_errors_total", pool)
+        raise
+    finally:
+        metrics.observe("db_exec_seconds", pool, time.perf_counter() - start)
+
+async def run_db(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        DB_WRITE_EXECUTOR, _timed_job, "write", time.perf_counter(), fn, args
+    )
+
+async def run_read(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        DB_READ_EXECUTOR, _timed_job, "read", time.perf_counter(), fn, args
+    )
+
+def _fetchall(sql, params=()):
+    return db().execute(sql, params).fetchall()
+
+def _fetchone(sql, params=()):
+    return db().execute(sql, params).fetchone()
+
+def _execute(sql, params=()):
+    # -> (lastrowid, rowcount)
+    con = db()
+    with con:
+        cur = con.execute(sql, params)
+    return cur.lastrowid, cur.rowcount
+
+def _toggle_item(item_id):
+    con = db()
+    with con:
+        row = con.execute("SELECT is_active FROM items WHERE id=?", (item_id,)).fetchone()
+        if not row:
+            return None
+        newv = 0 if row["is_active"] else 1
+        con.execute("UPDATE items SET is_active=? WHERE id=?", (newv, item_id))
+    return newv
+
+def _create_broadcast(text, admin_id):
+    # total — hozirgi faol mijozlar soni (ETA uchun)
+    con = db()
+    with con:
+        return con.execute("""
+            INSERT INTO broadcasts(text, created_by, created_ts, total)
+            SELECT ?, ?, ?, COUNT(*) FROM customers WHERE blocked_at IS NULL
+            RETURNING *
+        """, (text, admin_id, int(time.time()))).fetchall()[0]
+
+# Yetkazish slotlari: SLOT_MINUTES'lik oraliqlar (epoch bo'yicha tekislangan), har biriga SLOT_CAPACITY
+# buyurtma; bekor qilinganlar hisoblanmaydi.
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", "30"))
+SLOT_CAPACITY = int(os.getenv("SLOT_CAPACITY", "10"))
+SLOT_SECONDS = SLOT_MINUTES * 60
+
+class SlotFull(Exception):
+    def __init__(self, slot):
+        super().__init__(f"slot {slot} is full")
+        self.slot = slot
+
+def slot_of(ts):
+    return ts - ts % SLOT_SECONDS
+
+def _slot_count(con, slot):
+    return con.execute(
+        "SELECT COUNT(*) FROM orders WHERE scheduled_at >= ? AND scheduled_at < ? AND status != 'canceled'",
+        (slot, slot + SLOT_SECONDS)
+    ).fetchone()[0]
+
+def _insert_order_tx(con, o, lines):
+    # buyurtma va barcha qatorlari; commit'ni chaqiruvchi (OrderWriter) qiladi
+    created, ts = now_iso(), int(time.time())
+    scheduled_at = o.get("scheduled_at")
+    if scheduled_at and _slot_count(con, slot_of(scheduled_at)) >= SLOT_CAPACITY:
+        # handler tekshiruvidan keyin boshqa mijoz oxirgi joyni olgan bo'lishi mumkin;
+        # yagona yozuvchi oqimda tekshiruv va INSERT orasida poyga yo'q
+        raise SlotFull(slot_of(scheduled_at))
+    cur = con.execute("""
+        INSERT INTO orders(user_id,username,full_name,item_id,qty,delivery_type,address_text,latitude,longitude,
+                           contact_type,phone,tg_username,schedule_type,scheduled_time_text,scheduled_at,status,
+                           total_price,created_at,updated_at,created_ts)
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    """, (
+        o["user_id"], o["username"], o["full_name"],
+        lines[0]["item_id"], sum(l["qty"] for l in lines),
+        o["delivery_type"], o["address_text"], o["lat"], o["lng"],
+        o["contact_type"], o["phone"], o["tg_username"],
+        o["schedule_type"], o["scheduled_time_text"], scheduled_at,
+        "new", sum(l["qty"] * l["unit_price"] for l in lines), created, created, ts
+    ))
+    order_id = cur.lastrowid
+    con.executemany(
+        "INSERT INTO order_lines(order_id,item_id,title,qty,unit_price) VALUES(?,?,?,?,?)",
+        [(order_id, l["item_id"], l["title"], l["qty"], l["unit_price"]) for l in lines]
+    )
+    con.execute(
+        "INSERT INTO order_events(order_id,from_status,to_status,actor_id,created_at,ts,age) VALUES(?,NULL,'new',?,?,?,0)",
+        (order_id, o["user_id"], created, ts)
+    )
+    _touch_customer_tx(con, o["user_id"], o["username"], o["full_name"])
+    return order_id
+
+def _touch_customer_tx(con, user_id, username, full_name):
+    # /start yoki buyurtma: mijoz ro'yxatda, blok belgisi olinadi (bot qayta ishga tushirilgan)
+    ts = int(time.time())
+    con.execute("""
+        INSERT INTO customers(user_id,username,full_name,first_seen,last_seen) VALUES(?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, full_name=excluded.full_name,
+            last_seen=excluded.last_seen, blocked_at=NULL
+    """, (user_id, username, full_name, ts, ts))
+
+def _broadcast_checkpoint_tx(con, bc_id, cursor, sent, failed, blocked, blocked_ids, ahead_ids=()):
+    # bo'lak tugadi: progress va bloklaganlar bitta commit'da — restart shu joydan davom etadi.
+    # ahead_ids: cursor'dan keyin tugaganlar (to'xtatilganda uzluksiz bo'lmagan qism)
+    con.execute(
+        "UPDATE broadcasts SET last_user_id=?, sent=?, failed=?, blocked=? WHERE id=?",
+        (cursor, sent, failed, blocked, bc_id)
+    )
+    ts = int(time.time())
+    con.executemany("UPDATE customers SET blocked_at=? WHERE user_id=?", [(ts, uid) for uid in blocked_ids])
+    con.executemany("INSERT OR IGNORE INTO broadcast_done(broadcast_id, user_id) VALUES(?,?)",
+                    [(bc_id, uid) for uid in ahead_ids])
+
+def _update_status_tx(con, order_id, from_st, to_st, actor_id):
+    # Shartli o'tish: holat hali ham from_st bo'lsagina yoziladi (eskirgan tugma / ikki marta bosish
+    # ikkinchi marta hech narsa qilmaydi). -> mijoz user_id yoki None
+    now, ts = now_iso(), int(time.time())
+    row = con.execute(
+        "UPDATE orders SET status=?, updated_at=? WHERE id=? AND status=? RETURNING user_id, created_ts",
+        (to_st, now, order_id, from_st)
+    ).fetchone()
+    if row is None:
+        return None
+    con.execute(
+        "INSERT INTO order_events(order_id,from_status,to_status,actor_id,created_at,ts,age) VALUES(?,?,?,?,?,?,?)",
+        (order_id, from_st, to_st, actor_id, now, ts, ts - row["created_ts"] if row["created_ts"] else None)
+    )
+    return row["user_id"]
+
+WRITE_OPS = {
+    "insert_order": _insert_order_tx,
+    "update_status": _update_status_tx,
+    "touch_customer": _touch_customer_tx,
+    "broadcast_checkpoint": _broadcast_checkpoint_tx,
+}
+
+def _write_batch(ops):
+    # -> har bir op uchun natija yoki Exception. Hammasi bitta tranzaksiya (bitta commit);
+    # har op o'z SAVEPOINT'ida — bittasi yiqilsa qolganlari baribir yoziladi.
     con = db()
-    cur = con.cursor()
-    cur.execute("""
+    results = []
+    with con:
+        con.execute("BEGIN")
+        for op, args in ops:
+            con.execute("SAVEPOINT op")
+            try:
+                results.append(WRITE_OPS[op](con, *args))
+                con.execute("RELEASE op")
+            except Exception as e:
+                con.execute("ROLLBACK TO op")
+                con.execute("RELEASE op")
+                results.append(e)
+    return results
+
+# ====== Migrations ======
+# (version, sql) — tartib bilan, har biri bir marta bajariladi. Faqat oxiriga qo'shing,
+# mavjud qadamlarni o'zgartirmang: jonli bazada ular allaqachon qo'llangan.
+FTS_APOSTROPHES = "'`‘’ʻʼ"
+
+def _fts_norm(col):
+    # SQL ifoda: COALESCE(col,'') dan FTS_APOSTROPHES belgilari olib tashlanadi
+    expr = f"COALESCE({col}, '')"
+    for ch in FTS_APOSTROPHES:
+        lit = ch.replace("'", "''")
+        expr = f"replace({expr}, '{lit}', '')"
+    return expr
+
+MIGRATIONS = [
+    # 1: boshlang'ich sxema; IF NOT EXISTS — migratsiyadan oldingi bazalar ham mos keladi
+    (1, """
     CREATE TABLE IF NOT EXISTS items (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         category TEXT NOT NULL,              -- "food" or "dessert"
@@ -56,9 +399,7 @@ def init_db():
         photo2_file_id TEXT NOT NULL,
         is_active INTEGER DEFAULT 1,
         created_at TEXT NOT NULL
-    )
-    """)
-    cur.execute("""
+    );
     CREATE TABLE IF NOT EXISTS orders (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -78,14 +419,1031 @@ def init_db():
         status TEXT NOT NULL,                -- new/accepted/canceled/preparing/onway/delivered
         created_at TEXT NOT NULL,
         updated_at TEXT NOT NULL
+    );
+    """),
+    # 2: hot so'rovlar uchun indekslar (cust_pick_cat, admin_show_cat, status/user bo'yicha buyurtmalar)
+    (2, """
+    CREATE INDEX IF NOT EXISTS idx_items_cat_active ON items(category, is_active, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_items_cat ON items(category, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status, id);
+    CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, id);
+    """),
+    # 3: SqlitePersistence — user_data va suhbat holatlari restartdan keyin tiklanadi
+    (3, """
+    CREATE TABLE IF NOT EXISTS persist_user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,                  -- JSON
+        updated_at REAL NOT NULL             -- unix time
+    );
+    CREATE INDEX IF NOT EXISTS idx_persist_user_updated ON persist_user_data(updated_at);
+    CREATE TABLE IF NOT EXISTS persist_conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,                   -- JSON [chat_id, user_id]
+        state INTEGER NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (name, key)
+    );
+    CREATE INDEX IF NOT EXISTS idx_persist_conv_updated ON persist_conversations(updated_at);
+    """),
+    # 4: ko'p mahsulotli savat — buyurtma qatorlari. orders.item_id/qty moslik uchun qoladi
+    # (birinchi mahsulot / jami dona). Nom va narx buyurtma paytidagi holatida saqlanadi.
+    (4, """
+    CREATE TABLE IF NOT EXISTS order_lines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        qty INTEGER NOT NULL,
+        unit_price REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_order_lines_order ON order_lines(order_id);
+    ALTER TABLE orders ADD COLUMN total_price REAL;
+    INSERT INTO order_lines(order_id, item_id, title, qty, unit_price)
+        SELECT o.id, o.item_id, COALESCE(i.title, '#' || o.item_id), o.qty, COALESCE(i.price, 0)
+        FROM orders o LEFT JOIN items i ON i.id = o.item_id;
+    UPDATE orders SET total_price = (SELECT SUM(qty * unit_price) FROM order_lines l WHERE l.order_id = orders.id);
+    """),
+    # 5: holat o'tishlari tarixi (audit va vaqt metrikalari). Eski buyurtmalar uchun faqat
+    # yaratilish hodisasi tiklanadi — oraliq o'tishlar vaqti ma'lum emas.
+    (5, """
+    CREATE TABLE IF NOT EXISTS order_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL,
+        from_status TEXT,                    -- NULL: buyurtma yaratildi
+        to_status TEXT NOT NULL,
+        actor_id INTEGER,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events(order_id, id);
+    INSERT INTO order_events(order_id, from_status, to_status, actor_id, created_at)
+        SELECT id, NULL, 'new', user_id, created_at FROM orders;
+    """),
+    # 6: /stats uchun unix vaqt ustunlari. age — hodisa buyurtma yaratilganidan necha sekund keyin
+    # bo'lgani: qabul/yetkazish vaqti join'siz, bitta covering indeks oralig'idan olinadi.
+    (6, """
+    ALTER TABLE order_events ADD COLUMN ts INTEGER;
+    ALTER TABLE order_events ADD COLUMN age INTEGER;
+    UPDATE order_events SET ts = CAST(strftime('%s', created_at) AS INTEGER);
+    UPDATE order_events SET age = ts - (
+        SELECT c.ts FROM order_events c WHERE c.order_id = order_events.order_id AND c.from_status IS NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_order_events_status_ts ON order_events(to_status, ts, age);
+    ALTER TABLE orders ADD COLUMN created_ts INTEGER;
+    UPDATE orders SET created_ts = CAST(strftime('%s', created_at) AS INTEGER);
+    CREATE INDEX IF NOT EXISTS idx_orders_created_ts ON orders(created_ts, status);
+    DROP INDEX IF EXISTS idx_order_lines_order;
+    CREATE INDEX idx_order_lines_order ON order_lines(order_id, item_id, qty, unit_price);
+    """),
+    # 7: xodimlar rollari; ADMIN_ID env bazada bo'lmasa ham har doim admin
+    (7, """
+    CREATE TABLE IF NOT EXISTS staff (
+        user_id INTEGER PRIMARY KEY,
+        role TEXT NOT NULL CHECK (role IN ('admin', 'kitchen', 'courier')),
+        added_by INTEGER,
+        added_at TEXT NOT NULL
+    );
+    """),
+    # 8: mijozlar (tarqatma uchun) va tarqatmalar; mijozlar mavjud buyurtmalardan to'ldiriladi
+    (8, """
+    CREATE TABLE IF NOT EXISTS customers (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        first_seen INTEGER NOT NULL,
+        last_seen INTEGER NOT NULL,
+        blocked_at INTEGER
+    );
+    INSERT OR IGNORE INTO customers(user_id, username, full_name, first_seen, last_seen)
+    SELECT user_id, username, full_name,
+           COALESCE(MIN(created_ts), CAST(strftime('%s', 'now') AS INTEGER)),
+           COALESCE(MAX(created_ts), CAST(strftime('%s', 'now') AS INTEGER))
+    FROM orders GROUP BY user_id;
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        created_by INTEGER NOT NULL,
+        created_ts INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',   -- running / done / canceled
+        total INTEGER NOT NULL,
+        last_user_id INTEGER NOT NULL DEFAULT 0,  -- checkpoint: shu id'gacha ishlangan
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        report_message_id INTEGER,
+        finished_ts INTEGER
+    );
+    """),
+    # 9: menyu qidiruvi — contentless FTS5, trigger'lar bilan sinxron. Apostroflar (o‘, g', oʻ ...)
+    # olib tashlanadi: "lag‘mon", "lag'mon" va "lagmon" bitta token bo'ladi
+    (9, f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        title, description, content='',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+    CREATE TRIGGER IF NOT EXISTS items_fts_ai AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, title, description)
+        VALUES (new.id, {_fts_norm("new.title")}, {_fts_norm("new.description")});
+    END;
+    CREATE TRIGGER IF NOT EXISTS items_fts_ad AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, description)
+        VALUES ('delete', old.id, {_fts_norm("old.title")}, {_fts_norm("old.description")});
+    END;
+    CREATE TRIGGER IF NOT EXISTS items_fts_au AFTER UPDATE OF title, description ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, description)
+        VALUES ('delete', old.id, {_fts_norm("old.title")}, {_fts_norm("old.description")});
+        INSERT INTO items_fts(rowid, title, description)
+        VALUES (new.id, {_fts_norm("new.title")}, {_fts_norm("new.description")});
+    END;
+    INSERT INTO items_fts(rowid, title, description)
+    SELECT id, {_fts_norm("title")}, {_fts_norm("description")} FROM items;
+    """),
+    # 10: yetkazish vaqti unix ts sifatida (slot sig'imi va eslatmalar uchun). Eski buyurtmalarda
+    # faqat erkin matn bor (sana noma'lum) — ular NULL qoladi va slot hisobiga kirmaydi
+    (10, """
+    ALTER TABLE orders ADD COLUMN scheduled_at INTEGER;
+    CREATE INDEX IF NOT EXISTS idx_orders_scheduled ON orders(scheduled_at, status) WHERE scheduled_at IS NOT NULL;
+    """),
+    # 11: to'xtatilgan tarqatmada checkpoint'dan (last_user_id) keyin tugab ulgurgan qabul qiluvchilar —
+    # davom ettirilganda ularga qayta yuborilmaydi. Tarqatma tugagach tozalanadi
+    (11, """
+    CREATE TABLE IF NOT EXISTS broadcast_done (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID;
+    """),
+]
+
+def migrate():
+    con = db()
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        applied_at TEXT NOT NULL
     )
     """)
     con.commit()
-    con.close()
+    current = con.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, sql in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            con.executescript(
+                "BEGIN;\n" + sql +
+                f"\nINSERT INTO schema_version(version, applied_at) VALUES({version}, '{now_iso()}');\nCOMMIT;"
+            )
+        except Exception:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        log.info("DB migration %s applied", version)
+
+# ====== Order stats (/stats) ======
+# Hamma agregatlar covering indekslar bo'yicha SQL'da. Foizliklar uchun SQL har xil
+# age qiymatlari sonini qaytaradi (qatorlar emas) — Python faqat shu qisqa ro'yxatni yig'adi.
+def _percentiles(rows, ps):
+    # rows: [(qiymat, soni)] o'sish tartibida; nearest-rank
+    n = sum(c for _, c in rows)
+    out = []
+    for p in ps:
+        acc, hit = 0, None
+        for v, c in rows:
+            acc += c
+            if acc >= p * n:
+                hit = v
+                break
+        out.append(hit)
+    return n, out
+
+def _order_stats(since_ts):
+    # since_ts ichida sodir bo'lgan hodisalar: qabul / yetkazish shu oraliqda bo'lgan buyurtmalar
+    con = db()
+    durations = {}
+    for st in ("accepted", "delivered"):
+        rows = con.execute(
+            "SELECT age, COUNT(*) FROM order_events WHERE to_status=? AND ts>=? AND age IS NOT NULL "
+            "GROUP BY age ORDER BY age", (st, since_ts)
+        ).fetchall()
+        durations[st] = _percentiles(rows, (0.5, 0.95))
+    hourly = con.execute("""
+        SELECT COALESCE(SUM(c), 0) AS total, COALESCE(MAX(c), 0) AS peak FROM (
+            SELECT COUNT(*) AS c FROM orders WHERE created_ts >= ? GROUP BY created_ts / 3600
+        )
+    """, (since_ts,)).fetchone()
+    revenue = con.execute("""
+        SELECT i.category AS category, SUM(l.qty * l.unit_price) AS revenue, SUM(l.qty) AS units
+        FROM orders o
+        JOIN order_lines l ON l.order_id = o.id
+        LEFT JOIN items i ON i.id = l.item_id
+        WHERE o.created_ts >= ? AND o.status != 'canceled'
+        GROUP BY 1 ORDER BY 2 DESC
+    """, (since_ts,)).fetchall()
+    return {"accept": durations["accepted"], "deliver": durations["delivered"], "hourly": hourly, "revenue": revenue}
+
+# ====== Write-behind: buyurtma yozuvlari ======
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "256"))
+
+class OrderWriter:
+    """Buyurtma insert va status update'lari navbat orqali yig'ilib, guruh bo'lib commit qilinadi.
+    Oldingi batch yozilayotganda kelganlar keyingisiga tushadi: kam yukda kechikish bitta
+    tranzaksiya vaqti, pik paytida esa bitta commit ko'p buyurtmaga bo'linadi."""
+
+    def __init__(self):
+        self.queue = None
+        self._task = None
+        self.batches = 0
+        self.ops = 0
+        self.max_batch = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        # navbatdagi hamma narsa yozilgach to'xtaydi
+        if self._task:
+            await self.queue.put(None)
+            await self._task
+            self._task = None
+
+    def snapshot(self):
+        return {
+            "write_queue": self.queue.qsize() if self.queue else 0,
+            "write_batches": self.batches,
+            "write_ops": self.ops,
+            "write_batch_max": self.max_batch,
+        }
+
+    async def submit(self, op, *args):
+        if self._task is None:
+            # ilova ishga tushmagan (migratsiya skriptlari, bench): to'g'ridan-to'g'ri yozamiz
+            res = (await run_db(_write_batch, [(op, args)]))[0]
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait((op, args, fut))
+            res = await fut
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [await self.queue.get()]
+            while len(batch) < WRITE_BATCH_MAX and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if None in batch:
+                stopping = True
+                batch = [b for b in batch if b is not None]
+            if not batch:
+                continue
+            try:
+                results = await run_db(_write_batch, [(op, args) for op, args, _ in batch])
+            except Exception as e:
+                log.exception("Write batch failed (%d ops)", len(batch))
+                results = [e] * len(batch)
+            self.batches += 1
+            self.ops += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            for (_, _, fut), res in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(res)
+
+order_writer = OrderWriter()
+
+# ====== Repository (async) ======
+class Repo:
+    """Handler'lar uchun async DB API: o'qish DB_READ_EXECUTOR'da, yozish DB_WRITE_EXECUTOR'da."""
+
+    async def get_active_items(self, cat):
+        return await run_read(_fetchall, "SELECT * FROM items WHERE category=? AND is_active=1 ORDER BY id DESC", (cat,))
+
+    async def get_items_by_cat(self, cat, limit=20, before=None):
+        # keyset: before = oldingi sahifaning eng kichik id'si
+        return await run_read(
+            _fetchall, "SELECT * FROM items WHERE category=? AND id<? ORDER BY id DESC LIMIT ?",
+            (cat, before or 1 << 62, limit)
+        )
+
+    async def search_items(self, match, limit):
+        # -> aktiv mahsulot id'lari, relevantlik bo'yicha (nomdagi moslik tavsifdagidan og'irroq)
+        rows = await run_read(_fetchall, """
+            SELECT items_fts.rowid AS id FROM items_fts JOIN items ON items.id = items_fts.rowid
+            WHERE items_fts MATCH ? AND items.is_active = 1
+            ORDER BY bm25(items_fts, 10.0, 1.0) LIMIT ?
+        """, (match, limit))
+        return tuple(r["id"] for r in rows)
+
+    async def get_item(self, item_id, active_only=False):
+        sql = "SELECT * FROM items WHERE id=?" + (" AND is_active=1" if active_only else "")
+        return await run_read(_fetchone, sql, (item_id,))
+
+    async def insert_item(self, it):
+        item_id, _ = await run_db(_execute, """
+            INSERT INTO items(category,title,description,price,min_qty,max_qty,photo1_file_id,photo2_file_id,is_active,created_at)
+            VALUES(?,?,?,?,?,?,?,?,1,?)
+        """, (
+            it["category"], it["title"], it["description"], it["price"],
+            it["min_qty"], it["max_qty"], it["photo1"], it["photo2"], now_iso()
+        ))
+        return item_id
+
+    async def toggle_item(self, item_id):
+        # -> yangi is_active qiymati yoki None (topilmasa)
+        return await run_db(_toggle_item, item_id)
+
+    async def update_item_price(self, item_id, price):
+        await run_db(_execute, "UPDATE items SET price=? WHERE id=?", (price, item_id))
+
+    async def update_item_minmax(self, item_id, mn, mx):
+        await run_db(_execute, "UPDATE items SET min_qty=?, max_qty=? WHERE id=?", (mn, mx, item_id))
+
+    async def update_item_photos(self, item_id, p1, p2):
+        await run_db(_execute, "UPDATE items SET photo1_file_id=?, photo2_file_id=? WHERE id=?", (p1, p2, item_id))
+
+    async def insert_order(self, o, lines):
+        # lines: [{"item_id", "title", "qty", "unit_price"}, ...] — kamida bitta
+        return await order_writer.submit("insert_order", o, lines)
+
+    async def order_lines(self, order_ids):
+        # -> {order_id: [qatorlar]}; dashboard sahifasi uchun bitta so'rov
+        if not order_ids:
+            return {}
+        marks = ",".join("?" * len(order_ids))
+        rows = await run_read(
+            _fetchall, f"SELECT * FROM order_lines WHERE order_id IN ({marks}) ORDER BY id", tuple(order_ids)
+        )
+        out = {}
+        for r in rows:
+            out.setdefault(r["order_id"], []).append(r)
+        return out
+
+    async def recent_orders(self, limit=20):
+        return await run_read(_fetchall, "SELECT * FROM orders ORDER BY id DESC LIMIT ?", (limit,))
+
+    async def orders_page(self, status=None, since=None, before=None, after=None, limit=10):
+        # Keyset sahifalash: before -> eskiroq (id < before), after -> yangiroq (id > after).
+        # Natija har doim id DESC tartibida.
+        where, params = [], []
+        if status:
+            where.append("status=?"); params.append(status)
+        if since:
+            where.append("created_at>=?"); params.append(since)
+        if after:
+            where.append("id>?"); params.append(after)
+            order = "ASC"
+        else:
+            where.append("id<?"); params.append(before or 1 << 62)
+            order = "DESC"
+        sql = f"SELECT * FROM orders WHERE {' AND '.join(where)} ORDER BY id {order} LIMIT ?"
+        rows = await run_read(_fetchall, sql, (*params, limit))
+        return rows[::-1] if after else rows
+
+    async def order_stats(self, since_ts):
+        return await run_read(_order_stats, since_ts)
+
+    async def get_order(self, order_id):
+        return await run_read(_fetchone, "SELECT * FROM orders WHERE id=?", (order_id,))
+
+    async def update_status(self, order_id, from_st, to_st, actor_id=None):
+        # -> mijoz user_id (o'tish bajarildi) yoki None (holat allaqachon boshqa)
+        return await order_writer.submit("update_status", order_id, from_st, to_st, actor_id)
+
+    async def slot_load(self, start, end):
+        # -> {slot boshi: faol buyurtmalar soni} [start, end) oralig'ida
+        rows = await run_read(_fetchall, f"""
+            SELECT scheduled_at - scheduled_at % {SLOT_SECONDS} AS slot, COUNT(*) AS n FROM orders
+            WHERE scheduled_at >= ? AND scheduled_at < ? AND status != 'canceled'
+            GROUP BY slot
+        """, (start, end))
+        return {r["slot"]: r["n"] for r in rows}
+
+    async def slot_orders(self, slot):
+        # eslatma uchun: slotdagi hali yetkazilmagan buyurtmalar
+        return await run_read(_fetchall, """
+            SELECT * FROM orders WHERE scheduled_at >= ? AND scheduled_at < ? AND status NOT IN ('canceled', 'delivered')
+            ORDER BY scheduled_at, id
+        """, (slot, slot + SLOT_SECONDS))
+
+    async def upcoming_slots(self, since):
+        rows = await run_read(_fetchall, f"""
+            SELECT DISTINCT scheduled_at - scheduled_at % {SLOT_SECONDS} AS slot FROM orders
+            WHERE scheduled_at >= ? AND status NOT IN ('canceled', 'delivered')
+        """, (since,))
+        return [r["slot"] for r in rows]
+
+    async def staff(self):
+        return await run_read(_fetchall, "SELECT user_id, role FROM staff ORDER BY role, user_id")
+
+    async def set_staff(self, user_id, role, added_by):
+        await run_db(_execute, """
+            INSERT INTO staff(user_id, role, added_by, added_at) VALUES(?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET role=excluded.role, added_by=excluded.added_by
+        """, (user_id, role, added_by, now_iso()))
+
+    async def remove_staff(self, user_id):
+        # -> o'chirildimi
+        _, n = await run_db(_execute, "DELETE FROM staff WHERE user_id=?", (user_id,))
+        return n > 0
+
+    async def touch_customer(self, user_id, username, full_name):
+        await order_writer.submit("touch_customer", user_id, username, full_name)
+
+    async def create_broadcast(self, text, admin_id):
+        return await run_db(_create_broadcast, text, admin_id)
+
+    async def running_broadcast(self):
+        return await run_read(_fetchone, "SELECT * FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1")
+
+    async def last_broadcast(self):
+        return await run_read(_fetchone, "SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+
+    async def broadcast_recipients(self, bc_id, after, limit):
+        # keyset: user_id > checkpoint; bloklaganlar va checkpoint'dan keyin tugab ulgurganlar o'tkazib yuboriladi
+        rows = await run_read(
+            _fetchall,
+            """
+            SELECT user_id FROM customers c
+            WHERE user_id>? AND blocked_at IS NULL
+              AND NOT EXISTS (SELECT 1 FROM broadcast_done d WHERE d.broadcast_id=? AND d.user_id=c.user_id)
+            ORDER BY user_id LIMIT ?
+            """,
+            (after, bc_id, limit)
+        )
+        return [r["user_id"] for r in rows]
+
+    async def broadcast_checkpoint(self, bc_id, cursor, sent, failed, blocked, blocked_ids, ahead_ids=()):
+        await order_writer.submit("broadcast_checkpoint", bc_id, cursor, sent, failed, blocked, blocked_ids, ahead_ids)
+
+    async def set_broadcast_report(self, bc_id, message_id):
+        await run_db(_execute, "UPDATE broadcasts SET report_message_id=? WHERE id=?", (message_id, bc_id))
+
+    async def finish_broadcast(self, bc_id, status):
+        await run_db(
+            _execute, "UPDATE broadcasts SET status=?, finished_ts=? WHERE id=? AND status='running'",
+            (status, int(time.time()), bc_id)
+        )
+        await run_db(_execute, "DELETE FROM broadcast_done WHERE broadcast_id=?", (bc_id,))
+
+def _timed_query(name, fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            metrics.observe("db_query_seconds", name, time.perf_counter() - t0)
+    return wrapper
+
+# har bir Repo metodi — alohida "query" label'i
+for _name, _fn in list(vars(Repo).items()):
+    if asyncio.iscoroutinefunction(_fn):
+        setattr(Repo, _name, _timed_query(_name, _fn))
+
+repo = Repo()
+
+# ====== Catalog cache ======
+class Item:
+    __slots__ = ("id", "category", "title", "description", "price", "min_qty", "max_qty",
+                 "photo1_file_id", "photo2_file_id", "is_active", "version")
+
+    def __init__(self, row, version=0):
+        for k in self.__slots__[:-1]:
+            setattr(self, k, row[k])
+        self.version = version
+
+class ItemCard(NamedTuple):
+    caption: str   # Markdown, escape qilingan
+    media: tuple   # album rejimi: (InputMediaPhoto, InputMediaPhoto)
+    kb: InlineKeyboardMarkup  # min_qty bilan ochiladigan kb_qty
+
+# Telegram caption limiti 1024 (HTML teglari hisobga kirmaydi). Nom + tavsif + narx qatorlari
+# (~60) + compact rejimdagi son/jami bloki (~80) shu chegaradan oshmasligi uchun:
+CARD_TITLE_MAX = 100
+CARD_DESC_MAX = 700
+
+class Catalog:
+    """Menyu xotirada: mijoz yo'li menyu uchun SQL ishlatmaydi.
+    Admin har bir o'zgarishdan keyin refresh_item() chaqiradi (write-through)."""
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_cat = {}  # category -> aktiv Item'lar, id DESC
+        self.cards = {}   # (item_id, version) -> ItemCard
+        self.all_active = ()  # aktiv mahsulot id'lari, id DESC (bo'sh qidiruv uchun)
+        self.generation = 0   # har o'zgarishda oshadi: qidiruv keshi kaliti
+        self._versions = itertools.count(1)
+
+    def load(self):
+        # startup'da, loop ishga tushishidan oldin
+        self.by_id = {r["id"]: Item(r, next(self._versions)) for r in db().execute("SELECT * FROM items")}
+        self.cards = {}
+        self._reindex()
+
+    def _reindex(self):
+        by_cat = {}
+        active = []
+        for it in sorted(self.by_id.values(), key=lambda i: i.id, reverse=True):
+            if it.is_active:
+                by_cat.setdefault(it.category, []).append(it)
+                active.append(it.id)
+        self.by_cat = by_cat
+        self.all_active = tuple(active)
+        self.generation += 1
+
+    def active(self, cat):
+        return self.by_cat.get(cat, [])
+
+    def get(self, item_id, active_only=False):
+        it = self.by_id.get(item_id)
+        if it is None or (active_only and not it.is_active):
+            return None
+        return it
+
+    def card(self, it):
+        """Tayyor kartochka: caption, media va ochilish klaviaturasi bir marta quriladi."""
+        key = (it.id, it.version)
+        c = self.cards.get(key)
+        if c is None:
+            title = clip(it.title, CARD_TITLE_MAX)
+            desc = clip(it.description, CARD_DESC_MAX)
+            # HTML: legacy Markdown *...* ichida ekranlashni qo'llamaydi, nomdagi "_"/"*" xabarni buzardi
+            caption = (
+                f"<b>{html.escape(title)}</b>\n{html.escape(desc)}\n"
+                f"💰 Bir dona: <b>{fmt_money(it.price)}</b>\n"
+                f"🔢 Min/Max: <b>{it.min_qty}–{it.max_qty}</b>"
+            )
+            media = (
+                InputMediaPhoto(it.photo1_file_id, caption=caption, parse_mode=ParseMode.HTML),
+                InputMediaPhoto(it.photo2_file_id),
+            )
+            c = self.cards[key] = ItemCard(caption, media, kb_qty(it.min_qty, it.max_qty, it.min_qty))
+        return c
+
+    async def refresh_item(self, item_id):
+        row = await repo.get_item(item_id)
+        old = self.by_id.get(item_id)
+        if old is not None:
+            self.cards.pop((item_id, old.version), None)
+        if row:
+            self.by_id[item_id] = Item(row, next(self._versions))
+        else:
+            self.by_id.pop(item_id, None)
+        self._reindex()
+
+catalog = Catalog()
+
+# ====== Menu search ======
+SEARCH_MAX = 100          # bitta so'rov uchun FTS natijalari
+SEARCH_MAX_TOKENS = 6
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+_search_token = re.compile(r"\w+")
+
+_search_strip = str.maketrans("", "", FTS_APOSTROPHES)
+
+def fts_query(text):
+    # foydalanuvchi matni -> xavfsiz FTS5 so'rovi: har bir so'z prefiks bo'yicha, hammasi (AND)
+    tokens = _search_token.findall(text.lower().translate(_search_strip))[:SEARCH_MAX_TOKENS]
+    return " ".join(f'"{t}"*' for t in tokens)
+
+class MenuSearch:
+    """FTS5 natijalari (id'lar) kichik LRU'da. Kalit katalog avlodini ham o'z ichiga oladi —
+    admin o'zgarishidan keyin eski natijalar shunchaki ishlatilmaydi va siqib chiqariladi."""
+
+    def __init__(self, size):
+        self.size = size
+        self.cache = collections.OrderedDict()
+
+    async def ids(self, text):
+        match = fts_query(text)
+        if not match:
+            return catalog.all_active
+        key = (catalog.generation, match)
+        ids = self.cache.get(key)
+        if ids is not None:
+            self.cache.move_to_end(key)
+            return ids
+        ids = self.cache[key] = await repo.search_items(match, SEARCH_MAX)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return ids
+
+    async def items(self, text):
+        return [it for it in map(catalog.get, await self.ids(text)) if it and it.is_active]
+
+menu_search = MenuSearch(SEARCH_CACHE_SIZE)
+
+# ====== Staff roles ======
+STAFF_ROLES = ("admin", "kitchen", "courier")
+ROLE_LABELS = {"admin": "👑 Admin", "kitchen": "👨‍🍳 Oshxona", "courier": "🚗 Kuryer"}
+
+class Staff:
+    """Xodimlar rollari xotirada: is_admin/is_staff har update'da SQL'siz.
+    /staff o'zgarishlaridan keyin reload() chaqiriladi."""
+
+    def __init__(self):
+        self.roles = {ADMIN_ID: "admin"}
+        self.admins = filters.User(ADMIN_ID)  # admin buyruqlari filtri, reload'da yangilanadi
+
+    def _apply(self, rows):
+        roles = {r["user_id"]: r["role"] for r in rows}
+        roles[ADMIN_ID] = "admin"
+        self.roles = roles
+        self.admins.user_ids = {uid for uid, role in roles.items() if role == "admin"}
+
+    def load(self):
+        # startup'da, loop ishga tushishidan oldin
+        self._apply(db().execute("SELECT user_id, role FROM staff").fetchall())
+
+    async def reload(self):
+        self._apply(await repo.staff())
+
+    def role(self, user_id):
+        return self.roles.get(user_id)
+
+    def ids(self, roles=STAFF_ROLES):
+        return [uid for uid, role in self.roles.items() if role in roles]
+
+staff = Staff()
+
+# ====== Outbound rate limiting ======
+# Barcha Bot API chaqiruvlari PTB rate_limiter orqali o'tadi. Navbat ustuvorligi:
+# rate_limit_args=PRIO_URGENT (admin alert, status xabari) > PRIO_NORMAL (menyu, javoblar) > PRIO_BULK.
+PRIO_URGENT, PRIO_NORMAL, PRIO_BULK = 0, 1, 2
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))   # msg/s, Telegram limiti ~30
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))        # shaxsiy chat, msg/s
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_GROUP_RATE = 20 / 60                                      # guruhlar: 20 msg/min
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def take(self):
+        # -> 0 (token olindi) yoki token paydo bo'lguncha kutish sekundlari
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class OutboundLimiter(BaseRateLimiter):
+    """Chat bo'yicha va global token bucket'lar, ustuvorlik navbati va RetryAfter'da qayta urinish."""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._wake = None
+        self._task = None
+        self._paused_until = 0.0
+        self.depth = [0, 0, 0]
+        self.max_depth = 0
+        self.sent = 0
+        self.retry_after = 0
+        self.failed = 0
+
+    async def initialize(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self):
+        return {
+            "queue_urgent": self.depth[PRIO_URGENT],
+            "queue_normal": self.depth[PRIO_NORMAL],
+            "queue_bulk": self.depth[PRIO_BULK],
+            "queue_max": self.max_depth,
+            "sent": self.sent,
+            "retry_after": self.retry_after,
+            "failed": self.failed,
+        }
+
+    async def _dispatch(self):
+        # Global token'larni navbatdagilarga ustuvorlik tartibida tarqatadi
+        while True:
+            if not self._heap:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            wait = self.global_bucket.take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            _, _, fut = heapq.heappop(self._heap)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _acquire(self, chat_id, prio):
+        lane = self.chat_buckets.get(chat_id)
+        if lane is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST) if private else TokenBucket(TG_GROUP_RATE, 1)
+            lane = self.chat_buckets[chat_id] = (bucket, asyncio.Lock())
+            if len(self.chat_buckets) > 10000:
+                self._gc_buckets()
+        bucket, lock = lane
+        # Lock FIFO: bitta chatga xabarlar navbat tartibida chiqadi
+        async with lock:
+            while wait := bucket.take():
+                await asyncio.sleep(wait)
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (prio, next(self._seq), fut))
+        self._wake.set()
+        await fut
+
+    def _gc_buckets(self):
+        # to'lib qolgan (ya'ni uzoq vaqt jim turgan) chat bucket'larini tashlaymiz
+        now = time.monotonic()
+        self.chat_buckets = {
+            k: (b, lock) for k, (b, lock) in self.chat_buckets.items()
+            if lock.locked() or b.tokens + (now - b.stamp) * b.rate < b.capacity
+        }
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        prio = PRIO_NORMAL if rate_limit_args is None else rate_limit_args
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if chat_id is not None:
+                # answerCallbackQuery va h.k. chatga yozmaydi — ular kutmaydi
+                self.depth[prio] += 1
+                self.max_depth = max(self.max_depth, sum(self.depth))
+                t0 = time.perf_counter()
+                try:
+                    await self._acquire(chat_id, prio)
+                finally:
+                    self.depth[prio] -= 1
+                    metrics.observe("api_queue_seconds", endpoint, time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self.retry_after += 1
+                metrics.inc("api_retry_after_total", endpoint)
+                if attempt >= TG_MAX_RETRIES:
+                    self.failed += 1
+                    raise
+                log.warning("RetryAfter %ss on %s (chat %s), retrying", e.retry_after, endpoint, chat_id)
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                delay = e.retry_after
+            except Exception:
+                metrics.inc("api_errors_total", endpoint)
+                raise
+            finally:
+                metrics.observe("api_seconds", endpoint, time.perf_counter() - t0)
+            await asyncio.sleep(delay)
+
+# ====== Persistence ======
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "5"))            # sekund
+DRAFT_TTL = float(os.getenv("DRAFT_TTL_HOURS", "6")) * 3600
+HOUSEKEEPING_INTERVAL = 600
+# faollik bazadagi updated_at'ga shu oraliqdan siyrakroq yoziladi (har update'da emas)
+TOUCH_PERSIST_EVERY = min(HOUSEKEEPING_INTERVAL, DRAFT_TTL / 10)
+
+def _persist_write(users, convs, active=()):
+    now = time.time()
+    con = db()
+    with con:
+        # holati o'zgarmagan, lekin faol foydalanuvchilar: TTL faollikdan hisoblanadi
+        con.executemany("UPDATE persist_user_data SET updated_at=? WHERE user_id=?", [(now, uid) for uid in active])
+        con.executemany(
+            "UPDATE persist_conversations SET updated_at=? WHERE name=? AND key=?",
+            [(now, name, key) for uid in active for name, key in active[uid]],
+        )
+        con.executemany(
+            "INSERT INTO persist_user_data(user_id,data,updated_at) VALUES(?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+            [(uid, data, now) for uid, data in users.items() if data is not None],
+        )
+        con.executemany(
+            "DELETE FROM persist_user_data WHERE user_id=?",
+            [(uid,) for uid, data in users.items() if data is None],
+        )
+        con.executemany(
+            "INSERT INTO persist_conversations(name,key,state,updated_at) VALUES(?,?,?,?) "
+            "ON CONFLICT(name,key) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+            [(name, key, st, now) for (name, key), st in convs.items() if st is not None],
+        )
+        con.executemany(
+            "DELETE FROM persist_conversations WHERE name=? AND key=?",
+            [(name, key) for (name, key), st in convs.items() if st is None],
+        )
+
+def _persist_expire(cutoff):
+    con = db()
+    with con:
+        con.execute("DELETE FROM persist_user_data WHERE updated_at<?", (cutoff,))
+        con.execute("DELETE FROM persist_conversations WHERE updated_at<?", (cutoff,))
+
+class SqlitePersistence(BasePersistence):
+    """user_data va ConversationHandler holatlari SQLite'da.
+    PTB har PERSIST_INTERVAL'da o'zgarganlarini beradi — ular bufferlanib bitta tranzaksiyada yoziladi.
+    DRAFT_TTL davomida faol bo'lmagan (tashlab ketilgan) draft'lar va suhbat holatlari sweep() bilan
+    o'chiriladi; faollikni touch() har update'da belgilaydi."""
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=PERSIST_INTERVAL,
+        )
+        self._users = {}      # user_id -> JSON | None (o'chirish)
+        self._convs = {}      # (name, key) -> state | None
+        self._flush_task = None
+        self._active = set()  # bazada updated_at'i yangilanishi kerak bo'lgan user_id'lar
+        self.touched = {}     # user_id -> oxirgi faollik vaqti
+        self.stamped = {}     # user_id -> bazaga yozilgan oxirgi faollik vaqti
+        self.conv_keys = {}   # user_id -> {(name, key JSON)}: foydalanuvchining suhbat holatlari
+
+    def _seed(self, uid, ts):
+        self.touched[uid] = max(ts, self.touched.get(uid, 0))
+        self.stamped[uid] = self.touched[uid]
+
+    async def get_user_data(self):
+        rows = await run_read(
+            _fetchall, "SELECT user_id, data, updated_at FROM persist_user_data WHERE updated_at>=?",
+            (time.time() - DRAFT_TTL,)
+        )
+        for r in rows:
+            self._seed(r["user_id"], r["updated_at"])
+        return {r["user_id"]: json.loads(r["data"]) for r in rows}
+
+    async def get_conversations(self, name):
+        rows = await run_read(
+            _fetchall, "SELECT key, state, updated_at FROM persist_conversations WHERE name=? AND updated_at>=?",
+            (name, time.time() - DRAFT_TTL)
+        )
+        out = {}
+        for r in rows:
+            key = tuple(json.loads(r["key"]))
+            self.conv_keys.setdefault(key[-1], set()).add((name, r["key"]))
+            self._seed(key[-1], r["updated_at"])
+            out[key] = r["state"]
+        return out
+
+    def touch(self, user_id):
+        # har update'da: xotirada darhol, bazada TOUCH_PERSIST_EVERY'da bir marta
+        now = self.touched[user_id] = time.time()
+        if now - self.stamped.get(user_id, 0) >= TOUCH_PERSIST_EVERY:
+            self.stamped[user_id] = now
+            self._active.add(user_id)
+            self._schedule_flush()
+
+    def forget(self, user_id):
+        self.touched.pop(user_id, None)
+        self.stamped.pop(user_id, None)
+        self.conv_keys.pop(user_id, None)
+
+    async def update_user_data(self, user_id, data):
+        self._users[user_id] = json.dumps(data, ensure_ascii=False, default=str)
+        self.touched[user_id] = time.time()
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        k = (name, json.dumps(list(key)))
+        self._convs[k] = new_state
+        if new_state is None:
+            self.conv_keys.get(key[-1], set()).discard(k)
+        else:
+            self.conv_keys.setdefault(key[-1], set()).add(k)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # PTB update_* larni bitta gather'da chaqiradi; flush ular hammasidan keyin ishlaydi
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        users, convs = self._users, self._convs
+        if not users and not convs and not self._active:
+            return
+        active = {uid: tuple(self.conv_keys.get(uid, ())) for uid in self._active}
+        self._users, self._convs, self._active = {}, {}, set()
+        try:
+            await run_db(_persist_write, users, convs, active)
+        except Exception:
+            log.exception("Persistence flush failed (%d users, %d conversations)", len(users), len(convs))
+            # yangiroq yozuvlarni bosib ketmasdan qaytarib qo'yamiz
+            for k, v in users.items():
+                self._users.setdefault(k, v)
+            for k, v in convs.items():
+                self._convs.setdefault(k, v)
+            self._active.update(active)
+
+    async def flush(self):
+        if self._flush_task:
+            await self._flush_task
+        await self._flush()
+
+    def sweep(self, app):
+        # DRAFT_TTL davomida faol bo'lmaganlar: draft ham, suhbat holati ham xotiradan o'chadi
+        # (PTB o'chirishni keyingi persistence yangilanishida bazaga ham yetkazadi)
+        cutoff = time.time() - DRAFT_TTL
+        stale = {uid for uid, ts in self.touched.items() if ts < cutoff}
+        for uid in stale:
+            app.drop_user_data(uid)
+            self.forget(uid)
+        for conv in conversation_handlers(app):
+            # PTB suhbat holatini tashqaridan tugatish uchun ochiq API bermaydi
+            convs = conv._conversations
+            for key in [k for k in convs if k[-1] in stale or k[-1] not in self.touched]:
+                del convs[key]
+        # hech narsa yozilmagan bo'sh yozuvlar faqat xotirani egallaydi
+        for uid in [uid for uid, data in app.user_data.items() if not data and uid not in self.touched]:
+            app.drop_user_data(uid)
+        return cutoff
+
+    # bot_data / chat_data / callback_data saqlanmaydi
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+def conversation_handlers(app):
+    return [h for group in app.handlers.values() for h in group if isinstance(h, ConversationHandler)]
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # group -1: har update'da foydalanuvchi faolligi (draft/suhbat TTL'i shundan hisoblanadi)
+    if update.effective_user and context.application.persistence:
+        context.application.persistence.touch(update.effective_user.id)
+
+async def housekeeping(app):
+    while True:
+        await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+        try:
+            cutoff = app.persistence.sweep(app)
+            await run_db(_persist_expire, cutoff)
+        except Exception:
+            log.exception("Housekeeping failed")
 
 # ====== Helpers ======
+class CbData(NamedTuple):
+    action: str      # masalan "cust:page"
+    args: tuple      # tekshirilgan, tiplangan argumentlar: ("food", 2)
+
 def is_admin(u: Update) -> bool:
-    return bool(u.effective_user and u.effective_user.id == ADMIN_ID)
+    return bool(u.effective_user and staff.role(u.effective_user.id) == "admin")
+
+def is_staff(u: Update) -> bool:
+    return bool(u.effective_user and staff.role(u.effective_user.id))
+
+def maps_link(lat, lng) -> str:
+    return f"https://maps.google.com/?q={lat:.6f},{lng:.6f}"
 
 def cat_label(cat: str) -> str:
     return "🍲 Ovqat" if cat == "food" else "🍰 Shirinliklar"
@@ -100,9 +1458,89 @@ def status_label(st: str) -> str:
         "delivered": "📦 Yetkazildi",
     }.get(st, st)
 
+# Ruxsat etilgan o'tishlar: new → accepted → preparing → onway → delivered;
+# bekor qilish faqat tayyorlash boshlanmasdan.
+ORDER_TRANSITIONS = {
+    "new": ("accepted", "canceled"),
+    "accepted": ("preparing", "canceled"),
+    "preparing": ("onway",),
+    "onway": ("delivered",),
+    "delivered": (),
+    "canceled": (),
+}
+
 def now_iso():
     return datetime.utcnow().isoformat(timespec="seconds")
 
+# Mijoz yozgan vaqt shu mintaqada talqin qilinadi
+BOT_TZ = ZoneInfo(os.getenv("BOT_TZ", "Asia/Riyadh"))
+SCHEDULE_MIN_LEAD = int(os.getenv("SCHEDULE_MIN_LEAD_MIN", "30")) * 60
+SCHEDULE_MAX_DAYS = int(os.getenv("SCHEDULE_MAX_DAYS", "7"))
+SCHEDULE_DAYS = {
+    "bugun": 0, "бугун": 0, "сегодня": 0,
+    "ertaga": 1, "эртага": 1, "завтра": 1,
+    "indinga": 2, "индинга": 2, "послезавтра": 2,
+}
+_schedule_re = re.compile(
+    rf"^(?:(?P<word>{'|'.join(SCHEDULE_DAYS)}) |(?P<d>\d{{1,2}})[./](?P<m>\d{{1,2}}) )?"
+    r"(?:(?P<soat>soat|соат) )?(?P<h>\d{1,2})(?:[:.](?P<mi>\d{2}))?$"
+)
+
+def parse_schedule(text, now=None):
+    # "18:30", "Bugun 20:00", "ertaga 9.15", "bugun soat 12", "25.12 18:30" -> unix ts yoki None.
+    # Kun aytilmagan va vaqt bugun o'tib ketgan bo'lsa — ertangi kun; juda yaqin vaqtni
+    # book_slot rad etib, bo'sh slotlarni taklif qiladi.
+    m = _schedule_re.match(" ".join(text.lower().split()))
+    if not m or (m["mi"] is None and not m["soat"]):
+        return None
+    now = now or datetime.now(BOT_TZ)
+    h, mi = int(m["h"]), int(m["mi"] or 0)
+    if h > 23 or mi > 59:
+        return None
+    try:
+        if m["word"]:
+            day = now.date() + timedelta(days=SCHEDULE_DAYS[m["word"]])
+        elif m["d"]:
+            day = date(now.year, int(m["m"]), int(m["d"]))
+            if day < now.date():
+                day = day.replace(year=now.year + 1)  # dekabrda yozilgan yanvar sanasi
+        else:
+            day = now.date()
+    except ValueError:
+        return None
+    when = datetime.combine(day, dtime(h, mi), tzinfo=BOT_TZ)
+    if not (m["word"] or m["d"]) and when <= now:
+        when += timedelta(days=1)
+    return int(when.timestamp())
+
+def fmt_when(ts) -> str:
+    # -> "Bugun 18:30", "Ertaga 09:00", "25.12 18:30"
+    dt = datetime.fromtimestamp(ts, BOT_TZ)
+    day = {0: "Bugun", 1: "Ertaga"}.get((dt.date() - datetime.now(BOT_TZ).date()).days) or dt.strftime("%d.%m")
+    return f"{day} {dt:%H:%M}"
+
+def order_when(r) -> str:
+    # eski buyurtmalarda scheduled_at yo'q — mijoz yozgan matn ko'rsatiladi
+    if r["schedule_type"] == "now":
+        return "Hozir"
+    return fmt_when(r["scheduled_at"]) if r["scheduled_at"] else r["scheduled_time_text"]
+
+def fmt_duration(sec) -> str:
+    # 45 -> "45 s", 750 -> "12 daq", 4500 -> "1 soat 15 daq"
+    if sec is None:
+        return "—"
+    sec = int(sec)
+    if sec < 60:
+        return f"{sec} s"
+    if sec < 3600:
+        return f"{sec // 60} daq"
+    return f"{sec // 3600} soat {sec % 3600 // 60} daq"
+
+def clip(text, limit) -> str:
+    # uzun matnni Telegram chegarasiga sig'dirish: "…" bilan kesiladi
+    text = text or ""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
 def fmt_money(x: float) -> str:
     # 25 -> "25 SAR", 25.5 -> "25.5 SAR"
     try:
@@ -133,7 +1571,8 @@ def fmt_money(x: float) -> str:
     ADMIN_EDIT_MINMAX,
     ADMIN_EDIT_PHOTO1,
     ADMIN_EDIT_PHOTO2,
-) = range(19)
+    CUSTOMER_SEARCH,
+) = range(20)
 
 # ====== Keyboards ======
 def kb_admin_main():
@@ -148,21 +1587,20 @@ def kb_categories():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🍲 Ovqatlar", callback_data="cust:cat:food"),
          InlineKeyboardButton("🍰 Shirinliklar", callback_data="cust:cat:dessert")],
+        [InlineKeyboardButton("🔎 Qidirish", callback_data="cust:search"),
+         InlineKeyboardButton("🛒 Savat", callback_data="cust:cart")],
     ])
 
-def kb_order_status(order_id: int):
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Qabul qilindi", callback_data=f"admin:st:{order_id}:accepted"),
-            InlineKeyboardButton("❌ Bekor qilindi", callback_data=f"admin:st:{order_id}:canceled"),
-        ],
-        [
-            InlineKeyboardButton("👨‍🍳 Tayyorlanyapti", callback_data=f"admin:st:{order_id}:preparing"),
-            InlineKeyboardButton("🚗 Yo‘lda", callback_data=f"admin:st:{order_id}:onway"),
-        ],
-        [InlineKeyboardButton("📦 Yetkazildi", callback_data=f"admin:st:{order_id}:delivered")],
-    ])
+@functools.lru_cache(maxsize=1024)
+def kb_order_status(order_id: int, status: str = "new"):
+    # faqat joriy holatdan ruxsat etilgan o'tishlar; tugma kutilgan joriy holatni ham olib yuradi
+    row = [
+        InlineKeyboardButton(status_label(st), callback_data=f"admin:mv:{order_id}:{status}:{st}")
+        for st in ORDER_TRANSITIONS.get(status, ())
+    ]
+    return InlineKeyboardMarkup([row] if row else [])
 
+@functools.lru_cache(maxsize=512)
 def kb_qty(min_q, max_q, current):
     btns = []
     row = []
@@ -175,7 +1613,7 @@ def kb_qty(min_q, max_q, current):
     if row:
         btns.append(row)
     btns.append([
-        InlineKeyboardButton("➡️ Keyingi", callback_data="cust:qty:next"),
+        InlineKeyboardButton("🛒 Savatga qo‘shish", callback_data="cust:qty:next"),
         InlineKeyboardButton("❌ Bekor qilish", callback_data="cust:cancel"),
     ])
     return InlineKeyboardMarkup(btns)
@@ -209,46 +1647,83 @@ def kb_schedule_inline():
         [InlineKeyboardButton("❌ Buyurtmani bekor qilish", callback_data="cust:cancel")]
     ])
 
+def kb_main_menu_reply():
+    return ReplyKeyboardMarkup([["🏠 Bosh menu"]], resize_keyboard=True)
+
+def kb_admin_add_cat():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🍲 Ovqat", callback_data="admin:add:cat:food"),
+         InlineKeyboardButton("🍰 Shirinlik", callback_data="admin:add:cat:dessert")]
+    ])
+
+# O'zgarmas klaviaturalar importda bir marta quriladi (PTB obyektlari immutable — bo'lishish xavfsiz).
+# Parametrli kb_qty / kb_order_status esa LRU keshda.
+KB_ADMIN_MAIN = kb_admin_main()
+KB_CATEGORIES = kb_categories()
+KB_DELIVERY_REPLY = kb_delivery_reply()
+KB_CONTACT_REPLY = kb_contact_reply()
+KB_SCHEDULE_INLINE = kb_schedule_inline()
+KB_MAIN_MENU_REPLY = kb_main_menu_reply()
+KB_ADMIN_ADD_CAT = kb_admin_add_cat()
+
 # ====== CUSTOMER: cancel / main menu ======
+def clear_order(user_data, keep_cart=False):
+    user_data.pop("order", None)
+    user_data.pop("pick", None)
+    if not keep_cart:
+        user_data.pop("cart", None)
+
 async def cust_cancel_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.pop("order", None)
+    clear_order(context.user_data)
     await update.message.reply_text("❌ Buyurtma bekor qilindi.")
-    await update.message.reply_text("Bosh menyu:", reply_markup=kb_categories())
+    await update.message.reply_text("Bosh menyu:", reply_markup=KB_CATEGORIES)
     return CUSTOMER_BROWSE
 
-async def cust_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cust_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    context.user_data.pop("order", None)
+    clear_order(context.user_data)
     await q.message.reply_text("❌ Buyurtma bekor qilindi.")
-    await q.message.reply_text("Bosh menyu:", reply_markup=kb_categories())
+    await q.message.reply_text("Bosh menyu:", reply_markup=KB_CATEGORIES)
     return CUSTOMER_BROWSE
 
 async def cust_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.pop("order", None)
+    # savat saqlanib qoladi — mijoz menyuga qaytib yana qo'shishi mumkin
+    clear_order(context.user_data, keep_cart=True)
     if update.message:
-        await update.message.reply_text("Bosh menyu:", reply_markup=kb_categories())
+        await update.message.reply_text("Bosh menyu:", reply_markup=KB_CATEGORIES)
     else:
         q = update.callback_query
         await q.answer()
-        await q.message.reply_text("Bosh menyu:", reply_markup=kb_categories())
+        await q.message.reply_text("Bosh menyu:", reply_markup=KB_CATEGORIES)
     return CUSTOMER_BROWSE
 
 # ====== /start ======
+_known_customers = set()  # shu jarayonda customers'ga yozilganlar: /start har safar yozmaydi
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    init_db()
+    u = update.effective_user
+    if u.id not in _known_customers:
+        await repo.touch_customer(u.id, u.username, u.full_name)
+        _known_customers.add(u.id)
+
+    # deep link: inline qidiruv natijasidagi "Buyurtma berish" -> /start item_<id>
+    payload = context.args[0] if context.args else ""
+    if payload.startswith("item_") and (it := catalog.get(_int(payload[5:]), active_only=True)):
+        return await send_item(context, update.effective_chat.id, it)
+
     if is_admin(update):
-        await update.message.reply_text("👋 Admin panel", reply_markup=kb_admin_main())
+        await update.message.reply_text("👋 Admin panel", reply_markup=KB_ADMIN_MAIN)
         return ADMIN_MENU
 
     await update.message.reply_text(
         "Assalomu alaykum! Buyurtma berish uchun bo‘lim tanlang:",
-        reply_markup=kb_categories()
+        reply_markup=KB_CATEGORIES
     )
     return CUSTOMER_BROWSE
 
 # ====== ADMIN FLOW: add item ======
-async def admin_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
     context.user_data["add_item"] = {
@@ -261,17 +1736,13 @@ async def admin_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "photo1": None,
         "photo2": None,
     }
-    await q.message.reply_text("Mahsulot kategoriyasini tanlang:", reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🍲 Ovqat", callback_data="admin:add:cat:food"),
-         InlineKeyboardButton("🍰 Shirinlik", callback_data="admin:add:cat:dessert")]
-    ]))
+    await q.message.reply_text("Mahsulot kategoriyasini tanlang:", reply_markup=KB_ADMIN_ADD_CAT)
     return ADMIN_ADD_TITLE
 
-async def admin_add_pick_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_add_pick_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    cat = q.data.split(":")[-1]
-    context.user_data["add_item"]["category"] = cat
+    context.user_data["add_item"]["category"] = cb.args[0]
     await q.message.reply_text("Mahsulot nomini yozing (masalan: 'Palov'):")
     return ADMIN_ADD_TITLE
 
@@ -336,82 +1807,101 @@ async def admin_add_photo2(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_id = update.message.photo[-1].file_id
     context.user_data["add_item"]["photo2"] = file_id
 
-    it = context.user_data["add_item"]
-    con = db()
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO items(category,title,description,price,min_qty,max_qty,photo1_file_id,photo2_file_id,is_active,created_at)
-        VALUES(?,?,?,?,?,?,?,?,1,?)
-    """, (
-        it["category"], it["title"], it["description"], it["price"],
-        it["min_qty"], it["max_qty"], it["photo1"], it["photo2"], now_iso()
-    ))
-    con.commit()
-    con.close()
+    item_id = await repo.insert_item(context.user_data["add_item"])
+    await catalog.refresh_item(item_id)
 
-    await update.message.reply_text("✅ Saqlandi. Admin panelga qaytdingiz.", reply_markup=kb_admin_main())
+    await update.message.reply_text("✅ Saqlandi. Admin panelga qaytdingiz.", reply_markup=KB_ADMIN_MAIN)
     return ADMIN_MENU
 
 # ====== ADMIN: list items by category ======
-async def admin_show_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    cat = q.data.split(":")[-1]
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM items WHERE category=? ORDER BY id DESC LIMIT 20", (cat,))
-    rows = cur.fetchall()
-    con.close()
+ADMIN_PAGE_SIZE = 10
 
+async def render_admin_items(cat, before=None):
+    rows = await repo.get_items_by_cat(cat, ADMIN_PAGE_SIZE + 1, before)
+    has_more = len(rows) > ADMIN_PAGE_SIZE
+    rows = rows[:ADMIN_PAGE_SIZE]
     if not rows:
-        await q.message.reply_text(f"{cat_label(cat)}: hozircha mahsulot yo‘q.")
-        return ADMIN_MENU
+        return f"{cat_label(cat)}: hozircha mahsulot yo‘q.", None
 
+    lines = [f"<b>{cat_label(cat)}</b>", ""]
+    btns = []
     for r in rows:
-        txt = (
-            f"#{r['id']} — *{r['title']}*\n"
-            f"{r['description']}\n"
-            f"💰 Narx: *{fmt_money(r['price'])}*\n"
-            f"🔢 Min/Max: *{r['min_qty']}–{r['max_qty']}*\n"
-            f"🟢 Aktiv: {'Ha' if r['is_active'] else 'Yo‘q'}"
-        )
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🟢/🔴 Aktivni almashtirish", callback_data=f"admin:toggle:{r['id']}")],
-            [InlineKeyboardButton("💰 Narxni tahrirlash", callback_data=f"admin:edit:{r['id']}:price"),
-             InlineKeyboardButton("🔢 Min/Max tahrirlash", callback_data=f"admin:edit:{r['id']}:minmax")],
-            [InlineKeyboardButton("🖼 Rasmlarni tahrirlash (2ta)", callback_data=f"admin:edit:{r['id']}:photos")],
-        ])
-        await q.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
+        mark = "🟢" if r["is_active"] else "🔴"
+        lines.append(f"{mark} #{r['id']} — <b>{html.escape(r['title'])}</b> — {fmt_money(r['price'])}")
+        btns.append([InlineKeyboardButton(f"{mark} #{r['id']} {r['title']}", callback_data=f"admin:item:{r['id']}")])
+    nav = []
+    if before:
+        nav.append(InlineKeyboardButton("⏮ Boshiga", callback_data=f"admin:icat:{cat}:0"))
+    if has_more:
+        nav.append(InlineKeyboardButton("▶️ Keyingi", callback_data=f"admin:icat:{cat}:{rows[-1]['id']}"))
+    if nav:
+        btns.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(btns)
+
+def render_admin_item(r):
+    txt = (
+        f"#{r['id']} — <b>{html.escape(r['title'])}</b>\n"
+        f"{html.escape(r['description'] or '')}\n"
+        f"💰 Narx: <b>{fmt_money(r['price'])}</b>\n"
+        f"🔢 Min/Max: <b>{r['min_qty']}–{r['max_qty']}</b>\n"
+        f"🟢 Aktiv: {'Ha' if r['is_active'] else 'Yo‘q'}"
+    )
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🟢/🔴 Aktivni almashtirish", callback_data=f"admin:toggle:{r['id']}")],
+        [InlineKeyboardButton("💰 Narxni tahrirlash", callback_data=f"admin:edit:{r['id']}:price"),
+         InlineKeyboardButton("🔢 Min/Max tahrirlash", callback_data=f"admin:edit:{r['id']}:minmax")],
+        [InlineKeyboardButton("🖼 Rasmlarni tahrirlash (2ta)", callback_data=f"admin:edit:{r['id']}:photos")],
+        [InlineKeyboardButton("⬅️ Ro‘yxatga", callback_data=f"admin:icat:{r['category']}:0")],
+    ])
+    return txt, kb
+
+async def admin_show_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    text, kb = await render_admin_items(cb.args[0])
+    await q.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    return ADMIN_MENU
+
+async def admin_items_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    cat, before = cb.args
+    text, kb = await render_admin_items(cat, before or None)
+    await q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
     return ADMIN_MENU
 
-async def admin_toggle_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_item_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    item_id = int(q.data.split(":")[-1])
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT is_active FROM items WHERE id=?", (item_id,))
-    row = cur.fetchone()
-    if not row:
-        con.close()
+    r = await repo.get_item(cb.args[0])
+    if not r:
+        await q.message.reply_text("❌ Mahsulot topilmadi.")
+        return ADMIN_MENU
+    text, kb = render_admin_item(r)
+    await q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    return ADMIN_MENU
+
+async def admin_toggle_item(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    item_id = cb.args[0]
+    newv = await repo.toggle_item(item_id)
+    if newv is None:
         await q.message.reply_text("❌ Topilmadi.")
         return ADMIN_MENU
-    newv = 0 if row["is_active"] else 1
-    cur.execute("UPDATE items SET is_active=? WHERE id=?", (newv, item_id))
-    con.commit(); con.close()
-    await q.message.reply_text(f"✅ Item #{item_id} aktivligi o‘zgardi.")
+    await catalog.refresh_item(item_id)
+    # mahsulot kartasi o'sha xabarda yangilanadi
+    text, kb = render_admin_item(await repo.get_item(item_id))
+    await q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
     return ADMIN_MENU
 
 # ====== ADMIN: edit item (price/minmax/photos) ======
-async def admin_edit_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_edit_router(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    _, _, item_id, field = q.data.split(":")
-    item_id = int(item_id)
+    item_id, field = cb.args
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT * FROM items WHERE id=?", (item_id,))
-    it = cur.fetchone()
-    con.close()
+    it = await repo.get_item(item_id)
     if not it:
         await q.message.reply_text("❌ Mahsulot topilmadi.")
         return ADMIN_MENU
@@ -449,13 +1939,12 @@ async def admin_edit_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Narx noto‘g‘ri. Qayta yozing: 25 yoki 25.5")
         return ADMIN_EDIT_PRICE
 
-    con = db(); cur = con.cursor()
-    cur.execute("UPDATE items SET price=? WHERE id=?", (price, item_id))
-    con.commit(); con.close()
+    await repo.update_item_price(item_id, price)
+    await catalog.refresh_item(item_id)
 
     await update.message.reply_text(
         f"✅ Mahsulot #{item_id} narxi yangilandi: {fmt_money(price)}",
-        reply_markup=kb_admin_main()
+        reply_markup=KB_ADMIN_MAIN
     )
     context.user_data.pop("edit_item_id", None)
     return ADMIN_MENU
@@ -475,13 +1964,12 @@ async def admin_edit_minmax(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Format noto‘g‘ri. Masalan: `1 10`", parse_mode=ParseMode.MARKDOWN)
         return ADMIN_EDIT_MINMAX
 
-    con = db(); cur = con.cursor()
-    cur.execute("UPDATE items SET min_qty=?, max_qty=? WHERE id=?", (mn, mx, item_id))
-    con.commit(); con.close()
+    await repo.update_item_minmax(item_id, mn, mx)
+    await catalog.refresh_item(item_id)
 
     await update.message.reply_text(
         f"✅ Mahsulot #{item_id} Min/Max yangilandi: {mn}–{mx}",
-        reply_markup=kb_admin_main()
+        reply_markup=KB_ADMIN_MAIN
     )
     context.user_data.pop("edit_item_id", None)
     return ADMIN_MENU
@@ -513,133 +2001,359 @@ async def admin_edit_photo2(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     p2 = update.message.photo[-1].file_id
 
-    con = db(); cur = con.cursor()
-    cur.execute("UPDATE items SET photo1_file_id=?, photo2_file_id=? WHERE id=?", (p1, p2, item_id))
-    con.commit(); con.close()
+    await repo.update_item_photos(item_id, p1, p2)
+    await catalog.refresh_item(item_id)
 
-    await update.message.reply_text(f"✅ Mahsulot #{item_id} rasmlari yangilandi.", reply_markup=kb_admin_main())
+    await update.message.reply_text(f"✅ Mahsulot #{item_id} rasmlari yangilandi.", reply_markup=KB_ADMIN_MAIN)
     context.user_data.pop("edit_item_id", None)
     context.user_data.pop("edit_photo1", None)
     return ADMIN_MENU
 
 # ====== CUSTOMER FLOW ======
-async def cust_pick_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+MENU_PAGE_SIZE = 8
+MENU_DESC_MAX = 300  # 8 ta mahsulot bitta xabarning 4096 belgilik chegarasiga sig'ishi uchun
+
+def render_menu_page(cat, page):
+    # Bitta xabar: sahifadagi mahsulotlar + har biriga tugma + ◀️/▶️ navigatsiya
+    items = catalog.active(cat)
+    pages = max(1, -(-len(items) // MENU_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    chunk = items[page * MENU_PAGE_SIZE:(page + 1) * MENU_PAGE_SIZE]
+
+    lines = [f"<b>{cat_label(cat)}</b> — {page + 1}/{pages}", ""]
+    btns = []
+    for n, it in enumerate(chunk, start=page * MENU_PAGE_SIZE + 1):
+        # HTML: Markdown'da *...* ichidagi ekranlash ishlamaydi
+        lines.append(f"{n}. <b>{html.escape(clip(it.title, CARD_TITLE_MAX))}</b> — {fmt_money(it.price)}")
+        if it.description:
+            lines.append(html.escape(clip(it.description, MENU_DESC_MAX)))
+        btns.append([InlineKeyboardButton(f"🛒 {it.title} — {fmt_money(it.price)}", callback_data=f"cust:item:{it.id}")])
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"cust:page:{cat}:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"cust:page:{cat}:{page + 1}"))
+    if nav:
+        btns.append(nav)
+    btns.append([InlineKeyboardButton("🛒 Savat", callback_data="cust:cart")])
+    return "\n".join(lines), InlineKeyboardMarkup(btns)
+
+async def cust_pick_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    cat = q.data.split(":")[-1]
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT * FROM items WHERE category=? AND is_active=1 ORDER BY id DESC", (cat,))
-    items = cur.fetchall(); con.close()
+    cat = cb.args[0]
 
-    if not items:
+    if not catalog.active(cat):
         await q.message.reply_text("Hozircha bu bo‘limda mahsulot yo‘q.")
         return CUSTOMER_BROWSE
 
-    for it in items[:25]:
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🛒 Buyurtma", callback_data=f"cust:item:{it['id']}")]
-        ])
-        await q.message.reply_text(
-            f"*{it['title']}*\n{it['description']}\n💰 Narx: *{fmt_money(it['price'])}*",
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb
-        )
+    text, kb = render_menu_page(cat, 0)
+    await q.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
     return CUSTOMER_BROWSE
 
-async def cust_open_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cust_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    item_id = int(q.data.split(":")[-1])
+    cat, page = cb.args
+    text, kb = render_menu_page(cat, page)
+    await q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    return CUSTOMER_BROWSE
+
+# ====== CUSTOMER: search ======
+# /search <matn>, "🔎 Qidirish" tugmasi va inline rejim (@bot palov). Inline rejim BotFather'da
+# /setinline bilan yoqiladi; natijadagi tugma deep link (/start item_<id>) orqali botga qaytaradi.
+SEARCH_PAGE = 8
+INLINE_PAGE = 20
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "60"))  # Telegram tomonidagi kesh, sekund
+
+def render_search(text, items):
+    if not items:
+        return f"🔎 «{text}» bo‘yicha hech narsa topilmadi. Bo‘lim tanlang:", KB_CATEGORIES
+    lines = [f"🔎 «{text}» — {len(items)} ta", ""]
+    btns = []
+    for n, it in enumerate(items[:SEARCH_PAGE], start=1):
+        lines.append(f"{n}. {it.title} — {fmt_money(it.price)}")
+        btns.append([InlineKeyboardButton(f"🛒 {it.title} — {fmt_money(it.price)}", callback_data=f"cust:item:{it.id}")])
+    if len(items) > SEARCH_PAGE:
+        lines += ["", "Aniqroq yozing — ko‘proq mos keladi."]
+    btns.append([InlineKeyboardButton("🔎 Qidirish", callback_data="cust:search"),
+                 InlineKeyboardButton("🛒 Savat", callback_data="cust:cart")])
+    return "\n".join(lines), InlineKeyboardMarkup(btns)
+
+async def _reply_search(message, text):
+    body, kb = render_search(text, await menu_search.items(text))
+    await message.reply_text(body, reply_markup=kb)
+    return CUSTOMER_BROWSE
+
+async def cust_search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args).strip()
+    if not text:
+        await update.message.reply_text("🔎 Taom nomini yozing (masalan: palov):")
+        return CUSTOMER_SEARCH
+    return await _reply_search(update.message, text)
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT * FROM items WHERE id=? AND is_active=1", (item_id,))
-    it = cur.fetchone()
-    con.close()
+async def cust_search_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    await q.message.reply_text("🔎 Taom nomini yozing (masalan: palov):")
+    return CUSTOMER_SEARCH
+
+async def cust_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _reply_search(update.message, update.message.text.strip())
+
+@functools.lru_cache(maxsize=1024)
+def inline_result(item_id, version, bot_username):
+    # version faqat kesh kaliti uchun: mahsulot o'zgarsa yangi natija quriladi
+    it = catalog.get(item_id)
+    link = f"https://t.me/{bot_username}?start=item_{item_id}"
+    return InlineQueryResultCachedPhoto(
+        id=str(item_id),
+        photo_file_id=it.photo1_file_id,
+        title=it.title,
+        description=fmt_money(it.price),
+        caption=catalog.card(it).caption,
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Buyurtma berish", url=link)]]),
+    )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    offset = _int(iq.offset) or 0
+    ids = await menu_search.ids(iq.query)
+    page = [catalog.get(i, active_only=True) for i in ids[offset:offset + INLINE_PAGE]]
+    await iq.answer(
+        [inline_result(it.id, it.version, context.bot.username) for it in page if it],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(offset + INLINE_PAGE) if offset + INLINE_PAGE < len(ids) else "",
+    )
+
+# compact: bitta send_photo (caption + kb_qty); album: 2 rasmli media group + alohida son xabari
+ITEM_CARD_MODE = os.getenv("ITEM_CARD_MODE", "compact").lower()
+
+async def cust_open_item(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    item_id = cb.args[0]
+
+    it = catalog.get(item_id, active_only=True)
     if not it:
         await q.message.reply_text("❌ Mahsulot topilmadi yoki aktiv emas.")
         return CUSTOMER_BROWSE
-
-    context.user_data["order"] = {
-        "item_id": item_id,
-        "qty": it["min_qty"],
-        "min_qty": it["min_qty"],
-        "max_qty": it["max_qty"],
-        "unit_price": float(it["price"]),
-        "title": it["title"],
-        "delivery_type": None,
-        "address_text": None,
-        "lat": None,
-        "lng": None,
-        "contact_type": None,
-        "phone": None,
-        "tg_username": None,
-        "schedule_type": None,
-        "scheduled_time_text": None,
+    return await send_item(context, q.message.chat_id, it)
+
+async def send_item(context: ContextTypes.DEFAULT_TYPE, chat_id, it):
+    # mahsulot kartochkasi + son tanlash (menyu tugmasi, qidiruv, deep link)
+    # tanlanayotgan mahsulot; "Savatga qo'shish"da savatga o'tadi
+    context.user_data["pick"] = {
+        "item_id": it.id,
+        "qty": it.min_qty,
+        "min_qty": it.min_qty,
+        "max_qty": it.max_qty,
+        "unit_price": float(it.price),
+        "title": it.title,
     }
 
-    total = float(it["price"]) * int(it["min_qty"])
-
-    await context.bot.send_media_group(
-        chat_id=q.message.chat_id,
-        media=[
-            InputMediaPhoto(
-                it["photo1_file_id"],
-                caption=(
-                    f"*{it['title']}*\n{it['description']}\n"
-                    f"💰 Bir dona: *{fmt_money(it['price'])}*\n"
-                    f"🔢 Soni: *{it['min_qty']}*\n"
-                    f"🧾 Jami: *{fmt_money(total)}*\n"
-                    f"🔢 Min/Max: *{it['min_qty']}–{it['max_qty']}*"
-                ),
-                parse_mode=ParseMode.MARKDOWN,
-            ),
-            InputMediaPhoto(it["photo2_file_id"]),
-        ],
-    )
+    od = context.user_data["pick"]
+    card = catalog.card(it)
+    if ITEM_CARD_MODE == "compact":
+        # bitta chaqiruv: rasm + caption + son tanlash klaviaturasi
+        od["compact"] = True
+        text, _ = render_qty(od)
+        await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=it.photo1_file_id,
+            caption=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=card.kb,
+        )
+    else:
+        await context.bot.send_media_group(chat_id=chat_id, media=card.media)
+        text, kb = render_qty(od)
+        await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    od["qty_shown"] = od["qty"]
+    return CUSTOMER_PICK_QTY
 
-    await q.message.reply_text(
-        "Buyurtma sonini tanlang:",
-        reply_markup=kb_qty(it["min_qty"], it["max_qty"], it["min_qty"])
+# Son tanlash: jami narx o'sha bitta xabarda. Ketma-ket bosishlar QTY_DEBOUNCE oynasida
+# bitta edit'ga yig'iladi; ko'rsatilgan son o'zgarmagan bo'lsa edit umuman yuborilmaydi.
+QTY_DEBOUNCE = float(os.getenv("QTY_DEBOUNCE", "0.35"))
+_qty_edits = {}  # (chat_id, message_id) -> kutilayotgan edit task
+
+def _qty_body(od):
+    total = float(od["unit_price"]) * int(od["qty"])
+    return (
+        f"🔢 Soni: <b>{od['qty']}</b>\n"
+        f"🧾 Jami narx: <b>{fmt_money(total)}</b>\n\n"
+        "Buyurtma sonini tanlang:"
     )
-    return CUSTOMER_PICK_QTY
 
-async def cust_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def render_qty(od):
+    it = catalog.get(od["item_id"]) if od.get("compact") else None
+    if it:
+        # compact rejimda xabar — rasm caption'i, kartochka matni saqlanadi
+        text = f"{catalog.card(it).caption}\n\n{_qty_body(od)}"
+    else:
+        text = f"<b>{html.escape(od['title'])}</b>\n{_qty_body(od)}"
+    return text, kb_qty(od["min_qty"], od["max_qty"], od["qty"])
+
+async def _flush_qty_edit(key, message, od):
+    try:
+        await asyncio.sleep(QTY_DEBOUNCE)
+    finally:
+        _qty_edits.pop(key, None)
+    if od.get("qty_shown") == od["qty"]:
+        return
+    # edit paytida kelgan bosishlar keyingi task'da ko'rinishi uchun aynan chizilgan son saqlanadi
+    shown = od["qty"]
+    text, kb = render_qty(od)
+    try:
+        if od.get("compact"):
+            await message.edit_caption(caption=text, parse_mode=ParseMode.HTML, reply_markup=kb)
+        else:
+            await message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    od["qty_shown"] = shown
+
+async def cust_qty(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    data = q.data.split(":")[-1]
-    od = context.user_data.get("order")
+    choice = cb.args[0]  # "next" yoki son
+    od = context.user_data.get("pick")
     if not od:
         await q.message.reply_text("Buyurtma sessiyasi topilmadi. /start qiling.")
         return CUSTOMER_BROWSE
 
-    if data == "next":
-        await q.message.reply_text(
-            "Yetkazib berish uchun lokatsiya yuboring yoki manzilni qo‘lda yozing:",
-            reply_markup=kb_delivery_reply()
-        )
-        return CUSTOMER_DELIVERY
-
-    try:
-        chosen = int(data)
-    except:
-        return CUSTOMER_PICK_QTY
+    if choice == "next":
+        cart = context.user_data.setdefault("cart", [])
+        if not cart_add(cart, od["item_id"], od["qty"], od["max_qty"]):
+            await q.message.reply_text(f"❌ Savatda ko‘pi bilan {CART_MAX_LINES} xil mahsulot bo‘lishi mumkin.")
+            return CUSTOMER_PICK_QTY
+        context.user_data.pop("pick", None)
+        text, kb = render_cart(cart)
+        await q.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+        return CUSTOMER_BROWSE
 
+    chosen = choice
     if chosen < od["min_qty"] or chosen > od["max_qty"]:
         await q.message.reply_text("❌ Ruxsat etilgan oraliqdan tashqarida.")
         return CUSTOMER_PICK_QTY
 
     od["qty"] = chosen
+    key = (q.message.chat_id, q.message.message_id)
+    if key not in _qty_edits:
+        _qty_edits[key] = context.application.create_task(_flush_qty_edit(key, q.message, od), update=update)
+    return CUSTOMER_PICK_QTY
+
+# Savat user_data["cart"]da JSON-mos ro'yxat: [{"item_id": 3, "qty": 2}, ...].
+# Nom va narx har safar katalogdan olinadi, shuning uchun narx o'zgarsa savat ham yangilanadi.
+CART_MAX_LINES = 20
+
+def cart_add(cart, item_id, qty, max_qty):
+    for c in cart:
+        if c["item_id"] == item_id:
+            c["qty"] = min(c["qty"] + qty, max_qty)
+            return True
+    if len(cart) >= CART_MAX_LINES:
+        return False
+    cart.append({"item_id": item_id, "qty": qty})
+    return True
+
+def cart_lines(cart):
+    # -> [{"item_id", "title", "qty", "unit_price"}]; o'chirilgan/aktiv bo'lmagan mahsulotlar tushib qoladi
+    lines = []
+    for c in cart:
+        it = catalog.get(c["item_id"], active_only=True)
+        if it:
+            lines.append({"item_id": it.id, "title": it.title, "qty": c["qty"], "unit_price": float(it.price)})
+    return lines
+
+def render_cart(cart):
+    lines = cart_lines(cart)
+    if not lines:
+        return "🛒 Savat bo‘sh. Bo‘lim tanlang:", KB_CATEGORIES
+
+    text = ["🛒 <b>Savat</b>", ""]
+    btns = []
+    for n, l in enumerate(lines, start=1):
+        text.append(f"{n}. <b>{html.escape(l['title'])}</b> ×{l['qty']} — {fmt_money(l['qty'] * l['unit_price'])}")
+        btns.append([
+            InlineKeyboardButton(f"➖ {n}", callback_data=f"cust:cadj:dec:{l['item_id']}"),
+            InlineKeyboardButton(f"➕ {n}", callback_data=f"cust:cadj:inc:{l['item_id']}"),
+            InlineKeyboardButton(f"🗑 {n}", callback_data=f"cust:cadj:del:{l['item_id']}"),
+        ])
+    text += ["", f"🧾 Jami: <b>{fmt_money(sum(l['qty'] * l['unit_price'] for l in lines))}</b>"]
+    btns.append([
+        InlineKeyboardButton("➕ Yana qo‘shish", callback_data="cust:more"),
+        InlineKeyboardButton("✅ Rasmiylashtirish", callback_data="cust:checkout"),
+    ])
+    return "\n".join(text), InlineKeyboardMarkup(btns)
 
-    # ✅ son o'zgarganda jami narx ham yangilanadi
-    total = float(od.get("unit_price", 0.0)) * int(chosen)
+async def cust_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    text, kb = render_cart(context.user_data.get("cart") or [])
+    await q.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    return CUSTOMER_BROWSE
 
+async def cust_cart_adjust(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    op, item_id = cb.args
+    cart = context.user_data.get("cart") or []
+    line = next((c for c in cart if c["item_id"] == item_id), None)
+    it = catalog.get(item_id, active_only=True)
+    if line and it:
+        if op == "inc":
+            line["qty"] = min(line["qty"] + 1, it.max_qty)
+        elif op == "dec":
+            line["qty"] -= 1
+        # min_qty'dan kamaysa qator olib tashlanadi
+        if op == "del" or line["qty"] < it.min_qty:
+            cart.remove(line)
+    elif line:
+        cart.remove(line)
+
+    text, kb = render_cart(cart)
     try:
-        await q.message.reply_text(f"🧾 Jami narx: *{fmt_money(total)}*", parse_mode=ParseMode.MARKDOWN)
-    except Exception:
-        pass
+        await q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    except BadRequest as e:
+        # max_qty'da ➕ bosilsa: "message is not modified"
+        if "not modified" not in str(e):
+            raise
+    return CUSTOMER_BROWSE
 
-    await q.message.edit_reply_markup(reply_markup=kb_qty(od["min_qty"], od["max_qty"], chosen))
-    return CUSTOMER_PICK_QTY
+async def cust_more(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    await q.message.reply_text("Bo‘lim tanlang:", reply_markup=KB_CATEGORIES)
+    return CUSTOMER_BROWSE
+
+async def cust_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    if not cart_lines(context.user_data.get("cart") or []):
+        await q.message.reply_text("🛒 Savat bo‘sh. Bo‘lim tanlang:", reply_markup=KB_CATEGORIES)
+        return CUSTOMER_BROWSE
+
+    context.user_data["order"] = {
+        "delivery_type": None,
+        "address_text": None,
+        "lat": None,
+        "lng": None,
+        "contact_type": None,
+        "phone": None,
+        "tg_username": None,
+        "schedule_type": None,
+        "scheduled_time_text": None,
+        "scheduled_at": None,
+    }
+    await q.message.reply_text(
+        "Yetkazib berish uchun lokatsiya yuboring yoki manzilni qo‘lda yozing:",
+        reply_markup=KB_DELIVERY_REPLY
+    )
+    return CUSTOMER_DELIVERY
 
 async def cust_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
     od = context.user_data.get("order")
@@ -651,21 +2365,21 @@ async def cust_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
         od["delivery_type"] = "location"
         od["lat"] = update.message.location.latitude
         od["lng"] = update.message.location.longitude
-        await update.message.reply_text("Aloqa uchun telefon yuboring yoki telegram nik qoldiring:", reply_markup=kb_contact_reply())
+        await update.message.reply_text("Aloqa uchun telefon yuboring yoki telegram nik qoldiring:", reply_markup=KB_CONTACT_REPLY)
         return CUSTOMER_CONTACT
 
     txt = (update.message.text or "").strip()
     if txt == "✍️ Manzilni yozaman":
-        await update.message.reply_text("Manzilni yozing (mahalla/ko‘cha/uy raqami):", reply_markup=kb_delivery_reply())
+        await update.message.reply_text("Manzilni yozing (mahalla/ko‘cha/uy raqami):", reply_markup=KB_DELIVERY_REPLY)
         return CUSTOMER_ADDRESS_TEXT
 
     if txt:
         od["delivery_type"] = "address"
         od["address_text"] = txt
-        await update.message.reply_text("Aloqa uchun telefon yuboring yoki telegram nik qoldiring:", reply_markup=kb_contact_reply())
+        await update.message.reply_text("Aloqa uchun telefon yuboring yoki telegram nik qoldiring:", reply_markup=KB_CONTACT_REPLY)
         return CUSTOMER_CONTACT
 
-    await update.message.reply_text("Lokatsiya yuboring yoki manzilni yozing.", reply_markup=kb_delivery_reply())
+    await update.message.reply_text("Lokatsiya yuboring yoki manzilni yozing.", reply_markup=KB_DELIVERY_REPLY)
     return CUSTOMER_DELIVERY
 
 async def cust_address_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -676,7 +2390,7 @@ async def cust_address_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     od["delivery_type"] = "address"
     od["address_text"] = update.message.text.strip()
 
-    await update.message.reply_text("Aloqa uchun telefon yuboring yoki telegram nik qoldiring:", reply_markup=kb_contact_reply())
+    await update.message.reply_text("Aloqa uchun telefon yuboring yoki telegram nik qoldiring:", reply_markup=KB_CONTACT_REPLY)
     return CUSTOMER_CONTACT
 
 async def cust_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -690,33 +2404,33 @@ async def cust_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
         od["phone"] = update.message.contact.phone_number
     else:
         if (update.message.text or "").strip() == "👤 Telegram nik qoldiraman":
-            await update.message.reply_text("Telegram nikingizni yozing (masalan: @username):", reply_markup=kb_contact_reply())
+            await update.message.reply_text("Telegram nikingizni yozing (masalan: @username):", reply_markup=KB_CONTACT_REPLY)
             return CUSTOMER_PHONE
         txt = (update.message.text or "").strip()
         if txt.startswith("@"):
             od["contact_type"] = "username"
             od["tg_username"] = txt
         else:
-            await update.message.reply_text("Telefon yuboring yoki @username yozing.", reply_markup=kb_contact_reply())
+            await update.message.reply_text("Telefon yuboring yoki @username yozing.", reply_markup=KB_CONTACT_REPLY)
             return CUSTOMER_CONTACT
 
-    await update.message.reply_text("Buyurtma vaqtini tanlang:", reply_markup=kb_schedule_inline())
+    await update.message.reply_text("Buyurtma vaqtini tanlang:", reply_markup=KB_SCHEDULE_INLINE)
     return CUSTOMER_SCHEDULE
 
 async def cust_username_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     od = context.user_data.get("order")
     txt = (update.message.text or "").strip()
     if not txt.startswith("@"):
-        await update.message.reply_text("Iltimos @username formatida yozing. Masalan: @Saudia0dan", reply_markup=kb_contact_reply())
+        await update.message.reply_text("Iltimos @username formatida yozing. Masalan: @Saudia0dan", reply_markup=KB_CONTACT_REPLY)
         return CUSTOMER_PHONE
     od["contact_type"] = "username"
     od["tg_username"] = txt
 
-    await update.message.reply_text("Buyurtma vaqtini tanlang:", reply_markup=kb_schedule_inline())
+    await update.message.reply_text("Buyurtma vaqtini tanlang:", reply_markup=KB_SCHEDULE_INLINE)
     return CUSTOMER_SCHEDULE
 
 # ✅ TUZATILDI: "now" yo'q, faqat scheduled ishlaydi
-async def cust_schedule_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cust_schedule_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
     od = context.user_data.get("order")
@@ -729,7 +2443,7 @@ async def cust_schedule_pick(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await q.message.reply_text(
         "Vaqtni yozing (masalan: `18:30` yoki `Bugun 20:00`):",
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=kb_delivery_reply()
+        reply_markup=KB_DELIVERY_REPLY
     )
     return CUSTOMER_SCHEDULE_TIME
 
@@ -738,189 +2452,1046 @@ async def cust_schedule_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not od:
         await update.message.reply_text("Buyurtma sessiyasi topilmadi. /start qiling.")
         return CUSTOMER_BROWSE
-    od["scheduled_time_text"] = update.message.text.strip()
-    return await finalize_order(update.message, context)
+    text = update.message.text.strip()
+    ts = parse_schedule(text)
+    if ts is None:
+        await update.message.reply_text(
+            "❌ Vaqtni tushunmadim. Masalan: `18:30`, `Bugun soat 20`, `Ertaga 13:00`, `25.12 19:00`",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return CUSTOMER_SCHEDULE_TIME
+    return await book_slot(update.message, context, update.effective_user, ts, text)
 
-async def finalize_order(message, context: ContextTypes.DEFAULT_TYPE):
+async def cust_pick_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    # taklif qilingan bo'sh slot tugmasi
+    q = update.callback_query
+    await q.answer()
+    if not context.user_data.get("order"):
+        await q.message.reply_text("Buyurtma sessiyasi topilmadi. /start qiling.")
+        return CUSTOMER_BROWSE
+    ts = cb.args[0]
+    return await book_slot(q.message, context, q.from_user, ts, fmt_when(ts))
+
+SLOT_SUGGEST = 3
+SLOT_SUGGEST_SPAN = 6 * 3600  # so'ralgan vaqtdan ± shu oraliqda qidiriladi
+
+async def book_slot(message, context: ContextTypes.DEFAULT_TYPE, user, ts, text):
+    now = time.time()
+    slot = slot_of(ts)
+    if ts < now + SCHEDULE_MIN_LEAD or ts > now + SCHEDULE_MAX_DAYS * 86400:
+        reason = (f"⏱ Buyurtma kamida {SCHEDULE_MIN_LEAD // 60} daqiqa oldin va "
+                  f"{SCHEDULE_MAX_DAYS} kundan kechiktirmay beriladi.")
+    elif (await repo.slot_load(slot, slot + SLOT_SECONDS)).get(slot, 0) >= SLOT_CAPACITY:
+        reason = f"😔 {fmt_when(slot)}–{fmt_when(slot + SLOT_SECONDS)[-5:]} oralig‘ida joy qolmadi."
+    else:
+        od = context.user_data["order"]
+        od["scheduled_at"] = ts
+        od["scheduled_time_text"] = text
+        return await finalize_order(message, context, user)
+    return await offer_slots(message, ts, reason)
+
+async def free_slots(ts, n=SLOT_SUGGEST):
+    # so'ralgan vaqtga eng yaqin bo'sh slotlar (oldin ham, keyin ham)
+    now = int(time.time())
+    earliest = slot_of(now + SCHEDULE_MIN_LEAD + SLOT_SECONDS - 1)
+    latest = now + SCHEDULE_MAX_DAYS * 86400
+    ts = min(max(ts, earliest), latest)  # o'tib ketgan/juda uzoq vaqt: eng yaqin ruxsat etilganidan
+    lo, hi = slot_of(ts - SLOT_SUGGEST_SPAN), slot_of(ts + SLOT_SUGGEST_SPAN)
+    load = await repo.slot_load(lo, hi + SLOT_SECONDS)
+    free = [
+        s for s in range(max(lo, earliest), min(hi, latest) + 1, SLOT_SECONDS)
+        if s != slot_of(ts) and load.get(s, 0) < SLOT_CAPACITY
+    ]
+    return sorted(free, key=lambda s: (abs(s - ts), s))[:n]
+
+async def offer_slots(message, ts, reason):
+    slots = await free_slots(ts)
+    if not slots:
+        await message.reply_text(f"{reason}\n\nYaqin orada bo‘sh vaqt yo‘q — boshqa vaqt yozing.")
+        return CUSTOMER_SCHEDULE_TIME
+    kb = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(f"🕒 {fmt_when(s)}", callback_data=f"cust:slot:{s}")] for s in sorted(slots)]
+        + [[InlineKeyboardButton("❌ Buyurtmani bekor qilish", callback_data="cust:cancel")]]
+    )
+    await message.reply_text(f"{reason}\n\nBo‘sh vaqtni tanlang yoki boshqa vaqt yozing:", reply_markup=kb)
+    return CUSTOMER_SCHEDULE_TIME
+
+# Slot boshlanishidan SLOT_REMIND_BEFORE oldin oshxonaga shu slotdagi buyurtmalar ro'yxati.
+# JobQueue python-telegram-bot[job-queue] (APScheduler) bilan keladi; joblar xotirada —
+# on_startup kelgusi slotlarni bazadan qayta rejalashtiradi.
+SLOT_REMIND_BEFORE = int(os.getenv("SLOT_REMIND_BEFORE_MIN", "45")) * 60
+SLOT_REMIND_ROLES = ("admin", "kitchen")
+
+def schedule_slot_reminder(app, slot):
+    jq = app.job_queue
+    when = slot - SLOT_REMIND_BEFORE
+    if jq is None or when <= time.time():
+        # eslatma oynasi ichida berilgan buyurtma — yangi buyurtma alerti yetarli
+        return
+    name = f"slot:{slot}"
+    if not jq.get_jobs_by_name(name):
+        jq.run_once(slot_reminder, when=datetime.fromtimestamp(when, BOT_TZ), name=name, data=slot)
+
+async def slot_reminder(context: ContextTypes.DEFAULT_TYPE):
+    slot = context.job.data
+    rows = await repo.slot_orders(slot)
+    if not rows:
+        return
+    lines_by_order = await repo.order_lines([r["id"] for r in rows])
+    lines = [f"⏰ <b>{fmt_when(slot)}–{fmt_when(slot + SLOT_SECONDS)[-5:]}</b>: {len(rows)} ta buyurtma", ""]
+    for r in rows:
+        items = ", ".join(f"{html.escape(l['title'])} ×{l['qty']}" for l in lines_by_order.get(r["id"], ()))
+        lines.append(f"#{r['id']} {status_label(r['status'])} — {items}")
+    await notify_staff(context.bot, "\n".join(lines), roles=SLOT_REMIND_ROLES)
+
+# Yangi buyurtma alerti qaysi rollarga boradi (vergul bilan)
+ORDER_ALERT_ROLES = tuple(r for r in os.getenv("ORDER_ALERT_ROLES", "admin,kitchen,courier").split(",") if r in STAFF_ROLES)
+
+def html_to_plain(text):
+    # HTML alert'ning formatlashsiz nusxasi: <a href="u">t</a> -> "t: u", qolgan teglar olib tashlanadi
+    text = re.sub(r'<a href="([^"]*)">(.*?)</a>', r"\2: \1", text)
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
+
+async def _alert(bot, uid, text, reply_markup):
+    try:
+        return await bot.send_message(
+            chat_id=uid, text=text, parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup, rate_limit_args=PRIO_URGENT,
+        )
+    except BadRequest as e:
+        # formatlash rad etilsa ham buyurtma jim yo'qolmasin: oddiy matn bilan qayta
+        log.warning("Staff alert to %s rejected (%s), resending as plain text", uid, e)
+        return await bot.send_message(
+            chat_id=uid, text=html_to_plain(text), reply_markup=reply_markup, rate_limit_args=PRIO_URGENT,
+        )
+
+async def notify_staff(bot, text, reply_markup=None, roles=ORDER_ALERT_ROLES):
+    # text — HTML, foydalanuvchi matni html.escape bilan.
+    # barcha xodimlarga parallel; tezlik va ustuvorlikni limiter (PRIO_URGENT) boshqaradi
+    ids = staff.ids(roles)
+    results = await asyncio.gather(*(_alert(bot, uid, text, reply_markup) for uid in ids), return_exceptions=True)
+    for uid, r in zip(ids, results):
+        if isinstance(r, Exception):
+            log.error("Staff alert to %s failed: %s", uid, r)
+
+async def finalize_order(message, context: ContextTypes.DEFAULT_TYPE, user=None):
+    # user: tugma orqali chaqirilganda message botning xabari bo'ladi
     od = context.user_data.get("order")
     if not od:
         await message.reply_text("Buyurtma sessiyasi topilmadi. /start qiling.")
         return CUSTOMER_BROWSE
 
-    u = message.from_user
+    u = user or message.from_user
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT * FROM items WHERE id=?", (od["item_id"],))
-    it = cur.fetchone()
-    if not it:
-        con.close()
-        await message.reply_text("❌ Mahsulot topilmadi.")
+    cart = context.user_data.get("cart") or []
+    if not cart and od.get("item_id"):
+        # savatdan oldingi versiyada saqlangan bitta mahsulotli qoralama
+        cart = [{"item_id": od["item_id"], "qty": od["qty"]}]
+    items = cart_lines(cart)
+    if not items:
+        await message.reply_text("❌ Savatdagi mahsulotlar topilmadi.", reply_markup=KB_MAIN_MENU_REPLY)
+        clear_order(context.user_data)
         return CUSTOMER_BROWSE
 
-    unit_price = float(it["price"])
-    total_price = unit_price * int(od["qty"])
-
-    created = now_iso()
-    cur.execute("""
-        INSERT INTO orders(user_id,username,full_name,item_id,qty,delivery_type,address_text,latitude,longitude,
-                           contact_type,phone,tg_username,schedule_type,scheduled_time_text,status,created_at,updated_at)
-        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (
-        u.id,
-        u.username,
-        f"{u.first_name or ''} {u.last_name or ''}".strip(),
-        od["item_id"],
-        od["qty"],
-        od["delivery_type"],
-        od["address_text"],
-        od["lat"],
-        od["lng"],
-        od["contact_type"],
-        od["phone"],
-        od["tg_username"],
-        od["schedule_type"],
-        od["scheduled_time_text"],
-        "new",
-        created,
-        created
-    ))
-    order_id = cur.lastrowid
-    con.commit(); con.close()
+    total_price = sum(l["qty"] * l["unit_price"] for l in items)
 
+    try:
+        order_id = await repo.insert_order({
+            **od,
+            "user_id": u.id,
+            "username": u.username,
+            "full_name": f"{u.first_name or ''} {u.last_name or ''}".strip(),
+        }, items)
+    except SlotFull as e:
+        return await offer_slots(message, od["scheduled_at"], f"😔 {fmt_when(e.slot)} hozirgina to‘ldi.")
+    if od.get("scheduled_at"):
+        schedule_slot_reminder(context.application, slot_of(od["scheduled_at"]))
+
+    # mijoz kiritgan hamma narsa (ism, nik, manzil, vaqt matni) HTML'dan ekranlanadi
+    esc = html.escape
+    name = f"<b>{esc(u.first_name or '')}</b>"
     lines = [
-        f"📦 *Yangi buyurtma*  #{order_id}",
-        f"👤 Mijoz: *{u.first_name}* (@{u.username})" if u.username else f"👤 Mijoz: *{u.first_name}*",
-        f"🍽 Mahsulot: *{it['title']}* (#{it['id']})",
-        f"🔢 Soni: *{od['qty']}*",
-        f"💰 Bir dona: *{fmt_money(unit_price)}*",
-        f"🧾 Jami: *{fmt_money(total_price)}*",
-        f"⏱ Vaqt: *{'Hozir' if od['schedule_type']=='now' else od['scheduled_time_text']}*",
+        f"📦 <b>Yangi buyurtma</b>  #{order_id}",
+        f"👤 Mijoz: {name} (@{esc(u.username)})" if u.username else f"👤 Mijoz: {name}",
+        "🍽 Mahsulotlar:",
+    ]
+    lines += [
+        f"  • <b>{esc(l['title'])}</b> (#{l['item_id']}) ×{l['qty']} — {fmt_money(l['qty'] * l['unit_price'])}"
+        for l in items
+    ]
+    lines += [
+        f"🧾 Jami: <b>{fmt_money(total_price)}</b>",
+        f"⏱ Vaqt: <b>{esc(order_when(od) or '')}</b>",
     ]
     if od["delivery_type"] == "location":
-        lines.append("📍 Yetkazish: *Lokatsiya*")
+        lines.append(f'📍 Yetkazish: <a href="{esc(maps_link(od["lat"], od["lng"]))}">Lokatsiya</a>')
     else:
-        lines.append(f"📍 Manzil: *{od['address_text']}*")
+        lines.append(f"📍 Manzil: <b>{esc(od['address_text'] or '')}</b>")
 
     if od["contact_type"] == "phone":
-        lines.append(f"📞 Tel: *{od['phone']}*")
+        lines.append(f"📞 Tel: <b>{esc(od['phone'] or '')}</b>")
     else:
-        lines.append(f"👤 Nik: *{od['tg_username']}*")
+        lines.append(f"👤 Nik: <b>{esc(od['tg_username'] or '')}</b>")
 
-    admin_text = "\n".join(lines)
-    await context.bot.send_message(chat_id=ADMIN_ID, text=admin_text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb_order_status(order_id))
-
-    if od["delivery_type"] == "location":
-        await context.bot.send_location(chat_id=ADMIN_ID, latitude=od["lat"], longitude=od["lng"])
+    # lokatsiya xabar ichida havola — har bir xodimga bitta chaqiruv
+    await notify_staff(context.bot, "\n".join(lines), kb_order_status(order_id))
 
+    # rejalashtirilgan vaqt qanday talqin qilingani mijozga ham ko'rinsin
+    when = f"\n⏱ Vaqt: {fmt_when(od['scheduled_at'])}" if od.get("scheduled_at") else ""
     await message.reply_text(
-        f"✅ Buyurtmangiz qabul qilindi (ID: {order_id}). Holat o‘zgarishi admin tomonidan yuboriladi.",
-        reply_markup=ReplyKeyboardMarkup([["🏠 Bosh menu"]], resize_keyboard=True)
+        f"✅ Buyurtmangiz qabul qilindi (ID: {order_id}).{when}\nHolat o‘zgarishi admin tomonidan yuboriladi.",
+        reply_markup=KB_MAIN_MENU_REPLY
     )
 
-    context.user_data.pop("order", None)
-    await message.reply_text("Yana buyurtma berish uchun bo‘lim tanlang:", reply_markup=kb_categories())
+    clear_order(context.user_data)
+    await message.reply_text("Yana buyurtma berish uchun bo‘lim tanlang:", reply_markup=KB_CATEGORIES)
     return CUSTOMER_BROWSE
 
 # ====== ADMIN: orders list + status update ======
-async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT * FROM orders ORDER BY id DESC LIMIT 20")
-    rows = cur.fetchall(); con.close()
-
-    if not rows:
-        await q.message.reply_text("Buyurtmalar yo‘q.")
-        return ADMIN_MENU
+ORDERS_PAGE_SIZE = 10
+ORDER_FILTERS = [("all", "Hammasi"), ("new", "🆕"), ("accepted", "✅"), ("preparing", "👨‍🍳"), ("onway", "🚗")]
+DATE_FILTERS = [("all", "Barchasi"), ("today", "Bugun"), ("week", "7 kun")]
+
+def date_since(flt):
+    now = datetime.utcnow()
+    if flt == "today":
+        return now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat(timespec="seconds")
+    if flt == "week":
+        return (now - timedelta(days=7)).isoformat(timespec="seconds")
+    return None
+
+async def render_orders_dashboard(st="all", dt="all", cursor="b0"):
+    # cursor: "b<id>" — id'dan eskilari, "a<id>" — id'dan yangilari, "b0" — eng yangilari
+    direction, cid = cursor[0], int(cursor[1:] or 0)
+    rows = await repo.orders_page(
+        status=None if st == "all" else st,
+        since=date_since(dt),
+        before=cid if direction == "b" and cid else None,
+        after=cid if direction == "a" else None,
+        limit=ORDERS_PAGE_SIZE + 1,
+    )
+    # +1 qator keyingi sahifa borligini bildiradi
+    if direction == "a":
+        has_newer, rows = len(rows) > ORDERS_PAGE_SIZE, rows[-ORDERS_PAGE_SIZE:]
+        has_older = True
+    else:
+        has_older, rows = len(rows) > ORDERS_PAGE_SIZE, rows[:ORDERS_PAGE_SIZE]
+        has_newer = bool(cid)
 
+    flt = f"{st}:{dt}"
+    order_lines = await repo.order_lines([r["id"] for r in rows])
+    lines = [f"📦 *Buyurtmalar* — {dict(ORDER_FILTERS)[st]} / {dict(DATE_FILTERS)[dt]}", ""]
+    btns = []
     for r in rows:
-        await q.message.reply_text(
-            f"#{r['id']} — {status_label(r['status'])}\n"
-            f"User: {r['full_name']} (@{r['username']})\n"
-            f"Item #{r['item_id']} | qty {r['qty']}\n"
-            f"Time: {'Hozir' if r['schedule_type']=='now' else r['scheduled_time_text']}",
-            reply_markup=kb_order_status(r["id"])
+        ol = order_lines.get(r["id"], ())
+        title = f"{escape_markdown(ol[0]['title'])} ×{ol[0]['qty']}" if ol else f"#{r['item_id']} ×{r['qty']}"
+        if len(ol) > 1:
+            title += f" +{len(ol) - 1}"
+        # ism, nom va mijoz yozgan vaqt — foydalanuvchi matni, Markdown'dan ekranlanadi
+        lines.append(
+            f"#{r['id']} {status_label(r['status'])} — {escape_markdown(r['full_name'] or '')} — {title} — "
+            f"{escape_markdown(order_when(r) or '')}"
         )
+    if not rows:
+        lines.append("Buyurtmalar yo‘q.")
+    # buyurtmani ochish tugmalari, 5 tadan qatorda
+    row = []
+    for r in rows:
+        row.append(InlineKeyboardButton(f"#{r['id']}", callback_data=f"admin:od:{r['id']}:{flt}"))
+        if len(row) == 5:
+            btns.append(row); row = []
+    if row:
+        btns.append(row)
+
+    nav = []
+    if has_newer and rows:
+        nav.append(InlineKeyboardButton("◀️ Yangilar", callback_data=f"admin:ord:{flt}:a{rows[0]['id']}"))
+    if has_older and rows:
+        nav.append(InlineKeyboardButton("Eskilar ▶️", callback_data=f"admin:ord:{flt}:b{rows[-1]['id']}"))
+    if nav:
+        btns.append(nav)
+    btns.append([
+        InlineKeyboardButton(("• " if k == st else "") + label, callback_data=f"admin:ord:{k}:{dt}:b0")
+        for k, label in ORDER_FILTERS
+    ])
+    btns.append([
+        InlineKeyboardButton(("• " if k == dt else "") + label, callback_data=f"admin:ord:{st}:{k}:b0")
+        for k, label in DATE_FILTERS
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(btns)
+
+async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    text, kb = await render_orders_dashboard()
+    await q.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
     return ADMIN_MENU
 
-async def admin_set_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
     q = update.callback_query
     await q.answer()
-    _, _, oid, st = q.data.split(":")
-    order_id = int(oid)
+    text, kb = await render_orders_dashboard(*cb.args)
+    try:
+        await q.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
+    except BadRequest as e:
+        # bir xil filtr qayta bosilsa: "message is not modified"
+        if "not modified" not in str(e):
+            raise
+    return ADMIN_MENU
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT * FROM orders WHERE id=?", (order_id,))
-    r = cur.fetchone()
+async def admin_order_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    q = update.callback_query
+    await q.answer()
+    oid, st, dt = cb.args
+    r = await repo.get_order(oid)
     if not r:
-        con.close()
         await q.message.reply_text("❌ Buyurtma topilmadi.")
         return ADMIN_MENU
+    ol = (await repo.order_lines([r["id"]])).get(r["id"], ())
+    items = "\n".join(f"  • {l['title']} ×{l['qty']} — {fmt_money(l['qty'] * l['unit_price'])}" for l in ol)
+    text = (
+        f"#{r['id']} — {status_label(r['status'])}\n"
+        f"User: {r['full_name']} (@{r['username']})\n"
+        f"Items:\n{items or '  • #' + str(r['item_id']) + ' ×' + str(r['qty'])}\n"
+        f"Jami: {fmt_money(r['total_price'] or 0)}\n"
+        f"Time: {order_when(r)}\n"
+        f"Manzil: {r['address_text'] or (maps_link(r['latitude'], r['longitude']) if r['latitude'] is not None else 'Lokatsiya')}\n"
+        f"Aloqa: {r['phone'] or r['tg_username'] or '-'}"
+    )
+    kb = InlineKeyboardMarkup(
+        list(kb_order_status(r["id"], r["status"]).inline_keyboard)
+        + [[InlineKeyboardButton("⬅️ Ro‘yxatga", callback_data=f"admin:ord:{st}:{dt}:b0")]]
+    )
+    await q.edit_message_text(text, reply_markup=kb)
+    return ADMIN_MENU
 
-    cur.execute("UPDATE orders SET status=?, updated_at=? WHERE id=?", (st, now_iso(), order_id))
-    con.commit(); con.close()
+async def _refresh_status_kb(q, order_id, status):
+    # holat tugmalari yangilanadi, xabardagi boshqa qatorlar (masalan "⬅️ Ro‘yxatga") qoladi
+    keep = [
+        row for row in (q.message.reply_markup.inline_keyboard if q.message.reply_markup else ())
+        if row and not (row[0].callback_data or "").startswith(("admin:mv:", "admin:st:"))
+    ]
+    kb = InlineKeyboardMarkup(list(kb_order_status(order_id, status).inline_keyboard) + keep)
+    try:
+        await q.edit_message_reply_markup(reply_markup=kb)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+async def admin_set_status(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CbData):
+    # conv'dan tashqarida ishlaydi (STAFF_CALLBACKS): holat tugmasi suhbat holatiga tegmaydi.
+    # Bir nechta xodim bir vaqtda bossa — shartli UPDATE'da birinchisi yutadi.
+    q = update.callback_query
+    await q.answer()
+    if len(cb.args) == 3:
+        order_id, from_st, st = cb.args
+    else:
+        # eski formatdagi tugma (admin:st:<id>:<holat>): joriy holat bazadan olinadi
+        order_id, st = cb.args
+        r = await repo.get_order(order_id)
+        if not r:
+            await q.message.reply_text("❌ Buyurtma topilmadi.")
+            return None
+        from_st = r["status"]
+
+    if st not in ORDER_TRANSITIONS.get(from_st, ()):
+        await q.message.reply_text(
+            f"⚠️ Buyurtma #{order_id}: {status_label(from_st)} → {status_label(st)} o‘tishi mumkin emas."
+        )
+        return None
+
+    user_id = await repo.update_status(order_id, from_st, st, q.from_user.id)
+    if user_id is None:
+        r = await repo.get_order(order_id)
+        if not r:
+            await q.message.reply_text("❌ Buyurtma topilmadi.")
+            return None
+        await q.message.reply_text(
+            f"⚠️ Buyurtma #{order_id} holati allaqachon o‘zgargan: {status_label(r['status'])}"
+        )
+        await _refresh_status_kb(q, order_id, r["status"])
+        return None
 
     try:
         await context.bot.send_message(
-            chat_id=r["user_id"],
+            chat_id=user_id,
             text=f"📦 Buyurtma #{order_id} holati yangilandi: *{status_label(st)}*",
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.MARKDOWN,
+            rate_limit_args=PRIO_URGENT,
         )
     except Exception as e:
         log.warning("Customer notify failed: %s", e)
 
+    await _refresh_status_kb(q, order_id, st)
     await q.message.reply_text(f"✅ Buyurtma #{order_id} holati: {status_label(st)}")
-    return ADMIN_MENU
+    return None
+
+# ====== ADMIN: /staff ======
+STAFF_USAGE = (
+    "Format:\n"
+    "/staff — ro‘yxat\n"
+    "/staff add <user_id> <admin|kitchen|courier>\n"
+    "/staff add <-100…guruh_id> kitchen — oshxona guruhi\n"
+    "/staff del <user_id>"
+)
+
+def _chat_id(s):
+    # guruh/superguruh id'lari manfiy: -100123…
+    n = _int(s.removeprefix("-"))
+    return -n if n is not None and s.startswith("-") else n
+
+async def admin_staff(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if not args:
+        lines = ["👥 *Xodimlar*", ""]
+        lines += [
+            f"{ROLE_LABELS[role]} — `{uid}`" + (" (env)" if uid == ADMIN_ID else "")
+            for uid, role in sorted(staff.roles.items(), key=lambda x: (STAFF_ROLES.index(x[1]), x[0]))
+        ]
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    op, rest = args[0], args[1:]
+    uid = _chat_id(rest[0]) if rest else None
+    # guruh faqat alert oluvchi sifatida (kitchen): tugmalarni bosgan a'zoning o'z roli tekshiriladi
+    valid = uid is not None and (
+        (op == "add" and len(rest) == 2 and rest[1] in STAFF_ROLES and (uid > 0 or uid < 0 and rest[1] == "kitchen"))
+        or (op == "del" and len(rest) == 1)
+    )
+    if not valid:
+        await update.message.reply_text(STAFF_USAGE)
+        return
+    if uid == ADMIN_ID:
+        await update.message.reply_text("⚠️ ADMIN_ID env orqali berilgan, o‘zgartirib bo‘lmaydi.")
+        return
+
+    if op == "add":
+        await repo.set_staff(uid, rest[1], update.effective_user.id)
+        await staff.reload()
+        await update.message.reply_text(f"✅ {uid}: {ROLE_LABELS[rest[1]]}")
+    else:
+        removed = await repo.remove_staff(uid)
+        await staff.reload()
+        await update.message.reply_text(f"✅ {uid} o‘chirildi." if removed else "❌ Bunday xodim yo‘q.")
+
+# ====== ADMIN: /broadcast ======
+# Tarqatma PRIO_BULK'da ketadi: menyu va alertlar limiter navbatida har doim oldinda.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))                  # msg/s, TG_GLOBAL_RATE'dan past
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))                 # checkpoint oralig'i
+BROADCAST_REPORT_EVERY = float(os.getenv("BROADCAST_REPORT_EVERY", "15"))  # progress xabari, sekund
+BROADCAST_STOP_GRACE = float(os.getenv("BROADCAST_STOP_GRACE", "5"))      # to'xtatishda yo'ldagilarni kutish, s
+BROADCAST_USAGE = (
+    "Format:\n"
+    "/broadcast <matn> — barcha mijozlarga yuborish\n"
+    "/broadcast — holat\n"
+    "/broadcast stop — to‘xtatish"
+)
+
+class Broadcast:
+    """Bitta tarqatma. Qabul qiluvchilar customers'dan user_id bo'yicha bo'laklab o'qiladi,
+    har bo'lakdan keyin checkpoint — restart'dan keyin on_startup shu joydan davom ettiradi."""
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.text = row["text"]
+        self.admin_id = row["created_by"]
+        self.total = row["total"]
+        self.cursor = row["last_user_id"]
+        self.sent, self.failed, self.blocked = row["sent"], row["failed"], row["blocked"]
+        self.report_id = row["report_message_id"]
+        self.t0 = time.monotonic()
+        self.done0 = self.done  # tezlik shu ishga tushishdan beri o'lchanadi
+
+    @property
+    def done(self):
+        return self.sent + self.failed + self.blocked
+
+    def render(self, status="running"):
+        title = {"running": "📣 Tarqatma", "done": "✔️ Tarqatma tugadi", "canceled": "⏹ Tarqatma to‘xtatildi"}
+        lines = [
+            f"{title[status]} #{self.id}",
+            f"✅ Yuborildi: {self.sent} / {self.total}",
+            f"🚫 Bloklagan: {self.blocked}   ❌ Xato: {self.failed}",
+        ]
+        elapsed = time.monotonic() - self.t0
+        rate = (self.done - self.done0) / elapsed if elapsed > 0 else 0.0
+        if status == "running":
+            eta = max(self.total - self.done, 0) / rate if rate else None
+            lines.append(f"⚡ {rate:.1f} msg/s   ⏳ Qoldi: {fmt_duration(eta)}")
+        elif self.done > self.done0:
+            lines.append(f"⚡ {rate:.1f} msg/s   ⏱ {fmt_duration(elapsed)}")
+        return "\n".join(lines)
+
+    async def report(self, bot, status="running"):
+        # bitta progress xabari tahrirlanadi; id bazada — restart'dan keyin ham o'sha xabar
+        text = self.render(status)
+        try:
+            if self.report_id:
+                await bot.edit_message_text(text, chat_id=self.admin_id, message_id=self.report_id)
+            else:
+                msg = await bot.send_message(self.admin_id, text)
+                self.report_id = msg.message_id
+                await repo.set_broadcast_report(self.id, msg.message_id)
+        except Exception as e:
+            # hisobot yetmasa ham tarqatma davom etadi
+            if "not modified" not in str(e):
+                log.warning("Broadcast %s report failed: %s", self.id, e)
+
+    async def _send(self, bot, uid):
+        try:
+            await bot.send_message(chat_id=uid, text=self.text, rate_limit_args=PRIO_BULK)
+            return "sent"
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except Exception as e:
+            log.warning("Broadcast %s to %s failed: %s", self.id, uid, e)
+            return "failed"
+
+    async def _checkpoint(self, done, cursor):
+        # done: [(user_id, natija)]; cursor — shu id'gacha hammasi tugagan.
+        # cursor'dan keyin tugaganlar alohida saqlanadi: davom ettirilganda qayta yuborilmaydi
+        blocked_ids = [uid for uid, r in done if r == "blocked"]
+        for _, r in done:
+            metrics.inc("broadcast_messages_total", r)
+        results = [r for _, r in done]
+        self.sent += results.count("sent")
+        self.failed += results.count("failed")
+        self.blocked += len(blocked_ids)
+        self.cursor = cursor
+        _known_customers.difference_update(blocked_ids)
+        await repo.broadcast_checkpoint(
+            self.id, cursor, self.sent, self.failed, self.blocked, blocked_ids,
+            [uid for uid, _ in done if uid > cursor],
+        )
+
+    async def _stop(self, ids, tasks):
+        # to'xtatildi/restart: yo'ldagi xabarlar BROADCAST_STOP_GRACE gacha kutiladi, qolgani bekor.
+        # Tugaganlarning hammasi (uzluksiz bo'lmasa ham) saqlanadi
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=BROADCAST_STOP_GRACE)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        done = [(uid, t.result()) for uid, t in zip(ids, tasks) if not t.cancelled()]
+        n = next((i for i, t in enumerate(tasks) if t.cancelled()), len(tasks))
+        if done:
+            await self._checkpoint(done, ids[n - 1] if n else self.cursor)
+
+    async def run(self, bot):
+        interval = 1 / BROADCAST_RATE
+        next_report = 0.0
+        while ids := await repo.broadcast_recipients(self.id, self.cursor, BROADCAST_CHUNK):
+            tasks = []
+            try:
+                t = time.monotonic()
+                for uid in ids:
+                    # tekis tezlik: limiter navbatiga bir vaqtda minglab xabar tashlanmaydi
+                    if (delay := t - time.monotonic()) > 0:
+                        await asyncio.sleep(delay)
+                    tasks.append(asyncio.create_task(self._send(bot, uid)))
+                    t += interval
+                # wait(), gather() emas: bekor qilinganda yo'ldagi yuborishlarni o'zi bekor qilmaydi
+                await asyncio.wait(tasks)
+            except asyncio.CancelledError:
+                await self._stop(ids, tasks)
+                raise
+            await self._checkpoint(list(zip(ids, (t.result() for t in tasks))), ids[-1])
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + BROADCAST_REPORT_EVERY
+                await self.report(bot)
+        await repo.finish_broadcast(self.id, "done")
+        await self.report(bot, "done")
+
+def start_broadcast(app, row):
+    bc = Broadcast(row)
+
+    async def runner():
+        try:
+            await bc.run(app.bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # holat 'running' qoladi — keyingi ishga tushishda davom etadi
+            log.exception("Broadcast %s failed", bc.id)
+        finally:
+            if app.bot_data.get("broadcast", (None,))[0] is bc:
+                app.bot_data.pop("broadcast")
+
+    task = asyncio.create_task(runner())
+    app.bot_data["broadcast"] = (bc, task)
+    app.bot_data.setdefault("bg_tasks", []).append(task)
+    return bc
+
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+    current = context.bot_data.get("broadcast")
+
+    if not arg:
+        if current:
+            await update.message.reply_text(current[0].render())
+            return
+        last = await repo.last_broadcast()
+        text = Broadcast(last).render(last["status"]) + "\n\n" if last else ""
+        await update.message.reply_text(text + BROADCAST_USAGE)
+        return
+
+    if arg == "stop":
+        if not current:
+            await update.message.reply_text("Faol tarqatma yo‘q.")
+            return
+        bc, task = current
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await repo.finish_broadcast(bc.id, "canceled")
+        await bc.report(context.bot, "canceled")
+        return
+
+    if current:
+        await update.message.reply_text(f"⚠️ Tarqatma #{current[0].id} hali tugamagan. /broadcast stop")
+        return
+    row = await repo.create_broadcast(arg, update.effective_user.id)
+    start_broadcast(context.application, row)
+
+# ====== ADMIN: /slots ======
+SLOTS_AHEAD_HOURS = 24
+
+async def admin_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # kelgusi sutkadagi band slotlar: oshxona yuklamasi
+    now = int(time.time())
+    load = await repo.slot_load(slot_of(now), now + SLOTS_AHEAD_HOURS * 3600)
+    lines = [f"🗓 *Slotlar* — keyingi {SLOTS_AHEAD_HOURS} soat (sig‘im: {SLOT_CAPACITY})", ""]
+    for slot, n in sorted(load.items()):
+        filled = round(10 * min(n, SLOT_CAPACITY) / SLOT_CAPACITY)
+        lines.append(f"`{fmt_when(slot)}` {'▓' * filled}{'░' * (10 - filled)} {n}/{SLOT_CAPACITY}"
+                     + (" 🔴" if n >= SLOT_CAPACITY else ""))
+    if not load:
+        lines.append("Rejalashtirilgan buyurtmalar yo‘q.")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+# ====== ADMIN: /stats ======
+STATS_DEFAULT_DAYS = 7
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /stats [kun] — oxirgi N kun bo'yicha buyurtma vaqtlari va tushum
+    try:
+        days = int(context.args[0]) if context.args else STATS_DEFAULT_DAYS
+        if days < 1:
+            raise ValueError()
+    except ValueError:
+        await update.message.reply_text("Format: /stats yoki /stats 30 (kunlar soni)")
+        return
+
+    st = await repo.order_stats(int(time.time()) - days * 86400)
+    (acc_n, (acc50, acc95)), (dlv_n, (dlv50, dlv95)), hr = st["accept"], st["deliver"], st["hourly"]
+    lines = [
+        f"📊 *Statistika* — oxirgi {days} kun",
+        "",
+        f"📦 Buyurtmalar: *{hr['total']}* (o‘rtacha {hr['total'] / (days * 24):.2f}/soat, eng ko‘pi {hr['peak']}/soat)",
+        f"✅ Qabul qilish ({acc_n} ta): p50 *{fmt_duration(acc50)}*, p95 *{fmt_duration(acc95)}*",
+        f"📦 Yetkazish ({dlv_n} ta): p50 *{fmt_duration(dlv50)}*, p95 *{fmt_duration(dlv95)}*",
+        "",
+        "💰 Tushum (bekor qilinganlarsiz):",
+    ]
+    lines += [
+        f"  {cat_label(r['category']) if r['category'] in CATEGORIES else '?'}: "
+        f"*{fmt_money(r['revenue'])}* ({r['units']} dona)"
+        for r in st["revenue"]
+    ] or ["  —"]
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+# ====== ADMIN: /perf ======
+PERF_TOP = 8
+
+def _perf_rows(name):
+    return [
+        f"  {label}: n={n} o‘rt {mean * 1000:.1f}ms p95≤{p95 * 1000:g}ms"
+        for label, n, mean, p95 in metrics.top(name, PERF_TOP)
+    ] or ["  —"]
+
+async def admin_perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = ["⚙️ Perf (ishga tushgandan beri)", "", "Handler'lar:"]
+    lines += _perf_rows("handler_seconds")
+    lines += ["", "DB so‘rovlar:"] + _perf_rows("db_query_seconds")
+    lines += ["", "DB thread'larda bajarilish:"] + _perf_rows("db_exec_seconds")
+    lines += ["", "DB navbatda kutish:"] + _perf_rows("db_wait_seconds")
+    lines += ["", "Bot API:"] + _perf_rows("api_seconds")
+    lines += [
+        "",
+        f"Xatolar: handler {metrics.total('handler_errors_total')}, DB {metrics.total('db_errors_total')}, "
+        f"API {metrics.total('api_errors_total')}, RetryAfter {metrics.total('api_retry_after_total')}",
+    ]
+    lines += [f"{k}: {v}" for k, v in runtime_gauges(context.application)]
+    # Markdown'siz: label'larda "_" va ":" bor
+    await update.message.reply_text("\n".join(lines))
 
 # ====== Router for callbacks ======
-async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    data = q.data
+# callback_data bir marta ajratiladi va tekshiriladi; noto'g'ri data istisnosiz rad etiladi.
+CATEGORIES = ("food", "dessert")
+ORDER_STATUSES = ("new", "accepted", "canceled", "preparing", "onway", "delivered")
 
-    # customer
-    if data == "cust:cancel":
-        return await cust_cancel_cb(update, context)
-    if data.startswith("cust:cat:"):
-        return await cust_pick_cat(update, context)
-    if data.startswith("cust:item:"):
-        return await cust_open_item(update, context)
-    if data.startswith("cust:qty:"):
-        return await cust_qty(update, context)
-    if data.startswith("cust:sched:"):
-        return await cust_schedule_pick(update, context)
+def _int(s):
+    # isdigit() "²" kabi unicode raqamlarni ham qabul qiladi, int() esa yo'q
+    return int(s) if s.isascii() and s.isdigit() else None
+
+def _one_of(*options):
+    # dict.get — C darajadagi chaqiruv, Python frame ochilmaydi
+    return {o: o for o in options}.get
+
+def _qty(s):
+    return s if s == "next" else _int(s)
+
+def _cursor(s):
+    return s if s[:1] in ("a", "b") and _int(s[1:]) is not None else None
+
+_cat = _one_of(*CATEGORIES)
+_status = _one_of(*ORDER_STATUSES)
+_order_filter = _one_of(*(k for k, _ in ORDER_FILTERS))
+_date_filter = _one_of(*(k for k, _ in DATE_FILTERS))
 
+# prefix -> (handler, argument parserlari)
+CALLBACK_ROUTES = {
+    # customer
+    "cust:cancel": (cust_cancel_cb, ()),
+    "cust:cat": (cust_pick_cat, (_cat,)),
+    "cust:page": (cust_menu_page, (_cat, _int)),
+    "cust:item": (cust_open_item, (_int,)),
+    "cust:qty": (cust_qty, (_qty,)),
+    "cust:cart": (cust_cart, ()),
+    "cust:search": (cust_search_prompt, ()),
+    "cust:cadj": (cust_cart_adjust, (_one_of("inc", "dec", "del"), _int)),
+    "cust:more": (cust_more, ()),
+    "cust:checkout": (cust_checkout, ()),
+    "cust:sched": (cust_schedule_pick, (_one_of("now", "scheduled"),)),
+    "cust:slot": (cust_pick_slot, (_int,)),
     # admin
-    if data == "admin:add:start":
-        return await admin_add_start(update, context)
-    if data.startswith("admin:add:cat:"):
-        return await admin_add_pick_cat(update, context)
-    if data.startswith("admin:cat:"):
-        return await admin_show_cat(update, context)
-    if data.startswith("admin:toggle:"):
-        return await admin_toggle_item(update, context)
-    if data == "admin:orders":
-        return await admin_orders(update, context)
-    if data.startswith("admin:st:"):
-        return await admin_set_status(update, context)
-    if data.startswith("admin:edit:"):
-        return await admin_edit_router(update, context)
+    "admin:add:start": (admin_add_start, ()),
+    "admin:add:cat": (admin_add_pick_cat, (_cat,)),
+    "admin:cat": (admin_show_cat, (_cat,)),
+    "admin:icat": (admin_items_page, (_cat, _int)),
+    "admin:item": (admin_item_detail, (_int,)),
+    "admin:toggle": (admin_toggle_item, (_int,)),
+    "admin:orders": (admin_orders, ()),
+    "admin:ord": (admin_orders_page, (_order_filter, _date_filter, _cursor)),
+    "admin:od": (admin_order_detail, (_int, _order_filter, _date_filter)),
+    "admin:mv": (admin_set_status, (_int, _status, _status)),
+    "admin:st": (admin_set_status, (_int, _status)),  # eski xabarlardagi tugmalar
+    "admin:edit": (admin_edit_router, (_int, _one_of("price", "minmax", "photos"))),
+}
+# har bir yo'nalish o'z nomi bilan o'lchanadi ("cust:qty", "admin:mv", ...)
+CALLBACK_ROUTES = {k: (timed_handler(k, h), spec) for k, (h, spec) in CALLBACK_ROUTES.items()}
+
+# (prefix, bo'laklar soni) -> (prefix, handler, arg parserlari, prefix bo'laklari). Argumentsiz
+# yo'nalishlar uchun natija tayyor. Sovuq yo'l: bitta split, bitta dict lookup.
+_ROUTE_SHAPES = {}
+for _action, (_handler, _spec) in CALLBACK_ROUTES.items():
+    _n = _action.count(":") + 1
+    _ROUTE_SHAPES[(_action, _n + len(_spec))] = (
+        (_handler, CbData(_action, ())) if not _spec else (_action, _handler, _spec, _n)
+    )
 
-    await q.answer()
-    return ConversationHandler.END
+@functools.lru_cache(maxsize=4096)
+def parse_callback(data):
+    # -> (handler, CbData) yoki None. Prefix 2 yoki 3 bo'lakli ("admin:add:cat").
+    # Natija o'zgarmas, bir xil tugmalar ko'p bosiladi — LRU'da saqlanadi.
+    parts = data.split(":")
+    k = len(parts)
+    if k < 2:
+        return None
+    route = _ROUTE_SHAPES.get((parts[0] + ":" + parts[1], k))
+    if route is None:
+        if k < 3:
+            return None
+        route = _ROUTE_SHAPES.get((parts[0] + ":" + parts[1] + ":" + parts[2], k))
+        if route is None:
+            return None
+    if len(route) == 2:
+        return route
+    action, handler, spec, n = route
+    args = tuple(map(operator.call, spec, parts[n:]))
+    if None in args:
+        return None
+    return handler, CbData._make((action, args))
+
+# holat tugmalari har qanday xodim uchun; conv'dan oldin alohida handler ushlaydi
+STAFF_ACTIONS = frozenset({"admin:mv", "admin:st"})
+STAFF_CALLBACKS = r"^admin:(mv|st):"
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    parsed = parse_callback(q.data or "")
+    if parsed is None or (
+        parsed[1].action.startswith("admin:")
+        and not (is_staff(update) if parsed[1].action in STAFF_ACTIONS else is_admin(update))
+    ):
+        # noma'lum/eskirgan tugma: suhbat holati o'zgarmaydi
+        await q.answer()
+        return None
+    handler, cb = parsed
+    return await handler(update, context, cb)
+
+# ====== Webhook / HTTP server ======
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()          # bo'sh bo'lsa — polling
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8080")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_PATH = urlsplit(WEBHOOK_URL).path or "/"
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    413: "Payload Too Large", 503: "Service Unavailable",
+}
+
+class HttpServer:
+    """Kichik asyncio HTTP/1.1 server (keep-alive bilan): webhook va servis endpoint'lari.
+    Handler: async fn(headers, body) -> (status, content_type, bytes)."""
+
+    MAX_BODY = 1 << 20
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+        self._writers = set()  # ochiq keep-alive ulanishlar
+
+    def route(self, method, path, fn):
+        self.routes[(method, path)] = fn
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]  # port=0 bo'lsa haqiqiy port
+        log.info("HTTP server listening on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # 3.12.1+ da wait_closed() barcha ulanishlarni kutadi: keep-alive'larni o'zimiz yopamiz
+            for w in list(self._writers):
+                w.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=30)
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"too large", close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                fn = self.routes.get((method, urlsplit(target).path))
+                if fn is None:
+                    status, ctype, out = 404, "text/plain", b"not found"
+                else:
+                    status, ctype, out = await fn(headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, ctype, out, close)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception:
+            log.exception("HTTP handler error")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, writer, status, ctype, body, close=False):
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+def webhook_server(app, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    server = HttpServer(host, port)
+
+    async def on_update(headers, body):
+        # doimiy vaqtli taqqoslash: javob vaqti orqali token'ni taxmin qilib bo'lmaydi
+        got = headers.get("x-telegram-bot-api-secret-token", "")
+        if secret and not hmac.compare_digest(got.encode(), secret.encode()):
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except Exception:
+            return 400, "text/plain", b"bad update"
+        # Telegram'ga darhol 200 qaytaramiz; qayta ishlash Application navbatida
+        await app.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    async def on_health(headers, body):
+        out = {"ok": app.running, "pending_updates": app.update_queue.qsize()}
+        return (200 if app.running else 503), "application/json", json.dumps(out).encode()
+
+    server.route("POST", path, on_update)
+    server.route("GET", "/healthz", on_health)
+    return server
+
+def runtime_gauges(app):
+    out = [("update_queue", app.update_queue.qsize())]
+    if isinstance(app.update_processor, ChatSerialProcessor):
+        out.append(("updates_busy_chats", len(app.update_processor.chats)))
+    limiter = app.bot.rate_limiter
+    if isinstance(limiter, OutboundLimiter):
+        out += [("limiter_" + k, v) for k, v in limiter.snapshot().items()]
+    out += list(order_writer.snapshot().items())
+    return out
+
+def metrics_server(app, host=METRICS_LISTEN, port=METRICS_PORT):
+    server = HttpServer(host, port)
+
+    async def on_metrics(headers, body):
+        return 200, "text/plain; version=0.0.4", metrics.render(runtime_gauges(app)).encode()
+
+    server.route("GET", "/metrics", on_metrics)
+    return server
+
+async def run_webhook(app):
+    server = webhook_server(app)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with running(app):
+        await server.start()
+        await app.bot.set_webhook(
+            WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES
+        )
+        log.info("Webhook mode: %s", WEBHOOK_URL)
+        await stop.wait()
+        # avval yangi update qabul qilishni to'xtatamiz; running() navbatdagilar tugashini kutadi
+        await server.stop()
+
+# ====== Update processing ======
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "256"))
+
+class ChatSerialProcessor(BaseUpdateProcessor):
+    """Turli chatlarning update'lari parallel, bitta chat ichida esa qat'iy kelish tartibida.
+    Handler'lar blocking: suhbat holati keyingi update'dan oldin aniq bo'ladi (PendingState yo'q)."""
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self.chats = {}  # key -> [asyncio.Lock, kutayotganlar soni]
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        # Asosiy klass semaforni do_process_update'dan oldin oladi — unda bitta chatning navbati
+        # chat lock'ini kutib barcha slotlarni band qilib qo'yadi. Shuning uchun avval chat lock'i,
+        # keyin global semafor: kutayotgan update slot egallamaydi.
+        key = self._key(update)
+        if key is None:
+            async with self._semaphore:
+                await coroutine
+            return
+        entry = self.chats.get(key)
+        if entry is None:
+            entry = self.chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Lock FIFO; PTB update'larni navbat tartibida shu yerga yetkazadi
+            async with entry[0], self._semaphore:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chats[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # ====== Main ======
-def main():
-    init_db()
-    app = Application.builder().token(BOT_TOKEN).build()
+# ====== Lifecycle ======
+async def on_startup(app):
+    app.bot_data["bg_tasks"] = [asyncio.create_task(housekeeping(app))]
+    order_writer.start()
+    if METRICS_PORT:
+        server = app.bot_data["metrics_server"] = metrics_server(app)
+        await server.start()
+    # JobQueue xotirada: kelgusi slot eslatmalari bazadan qayta qo'yiladi
+    for slot in await repo.upcoming_slots(int(time.time())):
+        schedule_slot_reminder(app, slot)
+    # restart'dan oldin tugamagan tarqatma checkpoint'dan davom etadi
+    row = await repo.running_broadcast()
+    if row:
+        start_broadcast(app, row)
+
+async def on_stop(app):
+    # Bot hali yopilmagan (post_stop shutdown'dan oldin): tarqatma yo'ldagi xabarlarini
+    # yetkazib, oxirgi checkpoint'ni order_writer to'xtashidan oldin yozib ulgursin
+    tasks = app.bot_data.pop("bg_tasks", [])
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def on_shutdown(app):
+    if "metrics_server" in app.bot_data:
+        await app.bot_data.pop("metrics_server").stop()
+    await order_writer.stop()
+
+@contextlib.asynccontextmanager
+async def running(app):
+    # run_polling/run_webhook'siz ishga tushirish (webhook, bench): post_* hook'lar bilan
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        try:
+            yield app
+        finally:
+            await app.stop()
+            await app.post_stop(app)
+    await app.post_shutdown(app)
+
+def build_app(builder=None):
+    # builder: bench.py soxta Bot API (request) bilan tayyorlangan builder beradi
+    app = (
+        (builder or Application.builder())
+        .token(BOT_TOKEN)
+        .rate_limiter(OutboundLimiter())
+        .concurrent_updates(ChatSerialProcessor())
+        .persistence(SqlitePersistence())
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start), CommandHandler("search", cust_search_cmd)],
         states={
             # ADMIN
-            ADMIN_MENU: [CallbackQueryHandler(callback_router, block=False)],
+            ADMIN_MENU: [CallbackQueryHandler(callback_router)],
 
             ADMIN_ADD_TITLE: [
-                CallbackQueryHandler(callback_router, block=False),
+                CallbackQueryHandler(callback_router),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_title),
             ],
             ADMIN_ADD_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_desc)],
@@ -936,12 +3507,12 @@ def main():
 
             # CUSTOMER
             CUSTOMER_BROWSE: [
-                CallbackQueryHandler(callback_router, block=False),
+                CallbackQueryHandler(callback_router),
                 MessageHandler(filters.Regex("^🏠 Bosh menu$"), start),
             ],
 
             CUSTOMER_PICK_QTY: [
-                CallbackQueryHandler(callback_router, block=False),
+                CallbackQueryHandler(callback_router),
                 MessageHandler(filters.Regex("^🏠 Bosh menu$"), cust_main_menu),
                 MessageHandler(filters.Regex("^❌ Buyurtmani bekor qilish$"), cust_cancel_text),
             ],
@@ -971,12 +3542,19 @@ def main():
             ],
 
             CUSTOMER_SCHEDULE: [
-                CallbackQueryHandler(callback_router, block=False),
+                CallbackQueryHandler(callback_router),
                 MessageHandler(filters.Regex("^🏠 Bosh menu$"), cust_main_menu),
                 MessageHandler(filters.Regex("^❌ Buyurtmani bekor qilish$"), cust_cancel_text),
             ],
 
+            CUSTOMER_SEARCH: [
+                CallbackQueryHandler(callback_router),
+                MessageHandler(filters.Regex("^🏠 Bosh menu$"), start),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, cust_search_text),
+            ],
+
             CUSTOMER_SCHEDULE_TIME: [
+                CallbackQueryHandler(callback_router),
                 MessageHandler(filters.Regex("^🏠 Bosh menu$"), cust_main_menu),
                 MessageHandler(filters.Regex("^❌ Buyurtmani bekor qilish$"), cust_cancel_text),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, cust_schedule_time),
@@ -984,11 +3562,40 @@ def main():
         },
         fallbacks=[CommandHandler("start", start)],
         allow_reentry=True,
+        name="food_bot",
+        persistent=True,
         per_message=False,  # ✅ TUZATILDI: callback ishlashi uchun barqaror
     )
 
+    # callback_router ichidagi yo'nalishlar CALLBACK_ROUTES'da alohida o'lchanadi
+    for h in itertools.chain(conv.entry_points, conv.fallbacks, *conv.states.values()):
+        if h.callback is not callback_router:
+            h.callback = timed_handler(h.callback.__name__, h.callback)
+
+    # faollik belgisi (draft/suhbat TTL'i uchun) — hamma handler'lardan oldin, ularni to'smaydi
+    app.add_handler(TypeHandler(Update, track_activity), group=-1)
+
+    # admin buyruqlari suhbat holatiga tegmaydi — conv'dan oldin
+    admin_only = staff.admins
+    app.add_handler(CommandHandler("stats", timed_handler("admin_stats", admin_stats), filters=admin_only))
+    app.add_handler(CommandHandler("perf", timed_handler("admin_perf", admin_perf), filters=admin_only))
+    app.add_handler(CommandHandler("slots", timed_handler("admin_slots", admin_slots), filters=admin_only))
+    app.add_handler(CommandHandler("staff", timed_handler("admin_staff", admin_staff), filters=admin_only))
+    app.add_handler(CommandHandler("broadcast", timed_handler("admin_broadcast", admin_broadcast), filters=admin_only))
+    app.add_handler(CallbackQueryHandler(callback_router, pattern=STAFF_CALLBACKS))
+    app.add_handler(InlineQueryHandler(timed_handler("inline_search", inline_search)))
     app.add_handler(conv)
-    app.run_polling(close_loop=False)
+    return app
+
+def main():
+    migrate()
+    catalog.load()
+    staff.load()
+    app = build_app()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(close_loop=False)
 
 if __name__ == "__main__":
     main()